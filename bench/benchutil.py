@@ -0,0 +1,114 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2024 Gabriel Tremblay (github.com/gtremblay)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Shared helpers for the benchmark scripts in this directory: timing, result
+files and comparison of two result files.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+# Make the top level modules (uframe, protocol, dpsctl, uhej) importable
+# no matter where the benchmark is started from.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def time_call(func, repeat=5, min_time_s=0.2):
+    """
+    Time func() and return a dictionary with the best and median time per
+    call in nanoseconds. The loop count is scaled so that each repeat runs for
+    at least min_time_s.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time_s:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time_s / elapsed) + 1)
+    runs = sorted(timer.repeat(repeat=repeat, number=number))
+    per_call = [r / number * 1e9 for r in runs]
+    return {
+        'ns_per_op': per_call[0],
+        'median_ns_per_op': per_call[len(per_call) // 2],
+        'loops': number,
+        'repeat': repeat,
+    }
+
+
+def make_report(kind, results):
+    """
+    Wrap a results dictionary with information about the host it ran on
+    """
+    return {
+        'kind': kind,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def save_report(report, file_name):
+    with open(file_name, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+def load_report(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def compare_reports(baseline, current, key, threshold_pct):
+    """
+    Compare the 'key' metric of every result found in both reports. Return a
+    list of (name, baseline value, current value, change in percent) for all
+    results that got slower by more than threshold_pct.
+    """
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None or key not in old or key not in result or old[key] <= 0:
+            continue
+        change = (result[key] - old[key]) / old[key] * 100
+        if change > threshold_pct:
+            regressions.append((name, old[key], result[key], change))
+    return regressions
+
+
+def print_regressions(regressions, threshold_pct, unit):
+    if not regressions:
+        print("No regressions above {:.0f}%".format(threshold_pct))
+        return
+    print("{:d} regression(s) above {:.0f}%:".format(len(regressions), threshold_pct))
+    for name, old, new, change in regressions:
+        print("  {:<40} {:>12.1f} -> {:>12.1f} {} (+{:.1f}%)".format(name, old, new, unit, change))
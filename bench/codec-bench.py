@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+The MIT License (MIT)
+
+Copyright (c) 2024 Gabriel Tremblay (github.com/gtremblay)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Microbenchmarks for the uframe, protocol and uhej codecs.
+
+    python bench/codec-bench.py -o before.json
+    (hack hack hack)
+    python bench/codec-bench.py -o after.json --compare before.json
+
+Results are stored as JSON. With --compare, every benchmark that got slower
+than the threshold is listed and the script exits with status 1.
+"""
+
+import argparse
+import io
+import random
+import re
+import sys
+
+import benchutil
+import protocol
+import responses
+import uframe
+from uhej import uhej
+
+# Payloads
+QUERY_PARAMS = dict(('param{:02d}'.format(i), str(1000 + i * 37)) for i in range(16))
+QUERY_PARAMS.update({'voltage': '3300', 'current': '1500'})
+CHUNK_SIZE = 1024
+_rng = random.Random(1)
+RANDOM_CHUNK = bytearray(_rng.getrandbits(8) for _ in range(CHUNK_SIZE))
+# Every byte needs escaping, this is the worst case for both packing and unescaping
+ESCAPE_CHUNK = bytearray((uframe._SOF, uframe._DLE, uframe._EOF)[i % 3] for i in range(CHUNK_SIZE))
+CAL = {'A_ADC_K': 1.751, 'A_ADC_C': -1.2, 'A_DAC_K': 0.2366, 'A_DAC_C': 26.5,
+       'V_ADC_K': 13.0, 'V_ADC_C': -3.2, 'V_DAC_K': 0.0769, 'V_DAC_C': 1.9,
+       'VIN_ADC_K': 16.9, 'VIN_ADC_C': 37.1}
+SERVICES = [{'type': uhej.UDP, 'port': 5005 + i, 'name': 'opendps-{:02d}'.format(i)} for i in range(16)]
+
+
+def _unpacker(func, frame):
+    """
+    Return a callable unpacking the already decoded frame with func. The
+    unpack position is rewound before each call.
+    """
+    def run():
+        frame._unpack_pos = 0
+        return func(frame)
+    return run
+
+
+def _pack_frame(data):
+    f = uframe.uFrame()
+    for b in data:
+        f.pack8(b)
+    f.end()
+    return f
+
+
+def _set_frame(escaped):
+    def run():
+        # set_frame replaces its argument so hand it a fresh copy each time
+        return uframe.uFrame().set_frame(bytearray(escaped))
+    return run
+
+
+def _crc(data):
+    def run():
+        crc = 0
+        for b in data:
+            crc = uframe.crc16_ccitt(crc, b)
+        return crc
+    return run
+
+
+def _quiet(func):
+    """
+    create_temperature prints, keep that out of the output (not out of the timing)
+    """
+    def run():
+        stdout = sys.stdout
+        sys.stdout = _devnull
+        try:
+            return func()
+        finally:
+            sys.stdout = stdout
+    return run
+
+
+_devnull = io.StringIO()
+
+
+def benchmarks():
+    """
+    Return a list of (name, callable) to time
+    """
+    query_resp = responses.create_query_response(12000, 3300, 250, 1, 'cv', QUERY_PARAMS, 24.5, 31.2)
+    cal_resp = responses.create_cal_report(1234, 2345, 345, 456, 567, CAL)
+    version_resp = responses.create_version_response('f0e1d2c3', 'a1b2c3d4e5')
+    short_resp = responses.create_status_response(protocol.CMD_ENABLE_OUTPUT)
+    random_chunk = protocol.create_upgrade_data(RANDOM_CHUNK).get_frame()
+    escape_chunk = protocol.create_upgrade_data(ESCAPE_CHUNK).get_frame()
+
+    hello = uhej.hello(32768, "172.16.3.1", "aa:bb:cc:dd:ee:ff", "Testnode")
+    query = uhej.query(uhej.UDP, "opendps")
+    announce = uhej.announce(SERVICES)
+
+    return [
+        # uframe
+        ('uframe.crc16_ccitt[1KiB]', _crc(RANDOM_CHUNK)),
+        ('uframe.pack[query_response]', lambda: responses.create_query_response(12000, 3300, 250, 1, 'cv', QUERY_PARAMS, 24.5, 31.2)),
+        ('uframe.pack[1KiB]', lambda: _pack_frame(RANDOM_CHUNK)),
+        ('uframe.pack[1KiB escape heavy]', lambda: _pack_frame(ESCAPE_CHUNK)),
+        ('uframe.set_frame[query_response]', _set_frame(query_resp.get_frame())),
+        ('uframe.set_frame[short]', _set_frame(short_resp.get_frame())),
+        ('uframe.set_frame[1KiB]', _set_frame(random_chunk)),
+        ('uframe.set_frame[1KiB escape heavy]', _set_frame(escape_chunk)),
+        # protocol.create_*
+        ('protocol.create_response', lambda: protocol.create_response(protocol.CMD_QUERY, 1)),
+        ('protocol.create_cmd', lambda: protocol.create_cmd(protocol.CMD_QUERY)),
+        ('protocol.create_set_function', lambda: protocol.create_set_function('funcgen')),
+        ('protocol.create_enable_output', lambda: protocol.create_enable_output('on')),
+        ('protocol.create_set_parameter', lambda: protocol.create_set_parameter(['voltage=3300', 'current=1500'])),
+        ('protocol.create_set_calibration', lambda: protocol.create_set_calibration(['V_DAC_K=0.0769', 'V_DAC_C=1.9'])),
+        ('protocol.create_query_response', lambda: protocol.create_query_response(12000, 3300, 3290, 250, 1500, 1)),
+        ('protocol.create_wifi_status', lambda: protocol.create_wifi_status(protocol.WIFI_CONNECTED)),
+        ('protocol.create_lock', lambda: protocol.create_lock(1)),
+        ('protocol.create_ocp', lambda: protocol.create_ocp(5100)),
+        ('protocol.create_upgrade_start', lambda: protocol.create_upgrade_start(CHUNK_SIZE, 0x7e7d)),
+        ('protocol.create_upgrade_data[1KiB]', lambda: protocol.create_upgrade_data(RANDOM_CHUNK)),
+        ('protocol.create_upgrade_data[1KiB escape heavy]', lambda: protocol.create_upgrade_data(ESCAPE_CHUNK)),
+        ('protocol.create_temperature', _quiet(lambda: protocol.create_temperature(24.5))),
+        ('protocol.create_change_screen', lambda: protocol.create_change_screen(protocol.CHANGE_SCREEN_MAIN)),
+        ('protocol.create_set_brightness', lambda: protocol.create_set_brightness(75)),
+        # protocol.unpack_*
+        ('protocol.unpack_response', _unpacker(protocol.unpack_response, responses.decoded(short_resp))),
+        ('protocol.unpack_power_enable', _unpacker(protocol.unpack_power_enable, responses.decoded(short_resp))),
+        ('protocol.unpack_vout', _unpacker(protocol.unpack_vout, responses.decoded(query_resp))),
+        ('protocol.unpack_ilimit', _unpacker(protocol.unpack_ilimit, responses.decoded(query_resp))),
+        ('protocol.unpack_query_response', _unpacker(protocol.unpack_query_response, responses.decoded(query_resp))),
+        ('protocol.unpack_cal_report', _unpacker(protocol.unpack_cal_report, responses.decoded(cal_resp))),
+        ('protocol.unpack_wifi_status', _unpacker(protocol.unpack_wifi_status, responses.decoded(short_resp))),
+        ('protocol.unpack_lock', _unpacker(protocol.unpack_lock, responses.decoded(short_resp))),
+        ('protocol.unpack_ocp', _unpacker(protocol.unpack_ocp, responses.decoded(query_resp))),
+        ('protocol.unpack_temperature_report', _unpacker(protocol.unpack_temperature_report, responses.decoded(query_resp))),
+        ('protocol.unpack_version_response', _unpacker(protocol.unpack_version_response, responses.decoded(version_resp))),
+        # uhej
+        ('uhej.decode_frame[hello]', lambda: uhej.decode_frame(hello)),
+        ('uhej.decode_frame[query]', lambda: uhej.decode_frame(query)),
+        ('uhej.decode_frame[announce x16]', lambda: uhej.decode_frame(announce)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the uframe, protocol and uhej codecs')
+    parser.add_argument('-o', '--output', help="Store the results as JSON in this file")
+    parser.add_argument('-c', '--compare', help="Compare against the results in this JSON file")
+    parser.add_argument('-t', '--threshold', type=float, default=10.0, help="Regression threshold in percent (default 10)")
+    parser.add_argument('-k', '--filter', help="Only run benchmarks whose name matches this regular expression")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Number of timing repeats, the best one is kept (default 5)")
+    parser.add_argument('--min-time', type=float, default=0.2, help="Minimum time in seconds per repeat (default 0.2)")
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in benchmarks():
+        if args.filter and not re.search(args.filter, name):
+            continue
+        results[name] = benchutil.time_call(func, repeat=args.repeat, min_time_s=args.min_time)
+        print("{:<50} {:>12.1f} ns/op".format(name, results[name]['ns_per_op']))
+        sys.stdout.flush()
+
+    report = benchutil.make_report('codec', results)
+    if args.output:
+        benchutil.save_report(report, args.output)
+
+    if args.compare:
+        regressions = benchutil.compare_reports(benchutil.load_report(args.compare), report, 'ns_per_op', args.threshold)
+        benchutil.print_regressions(regressions, args.threshold, 'ns/op')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
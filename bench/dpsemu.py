@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+The MIT License (MIT)
+
+Copyright (c) 2024 Gabriel Tremblay (github.com/gtremblay)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+A local stand-in for an OpenDPS device, speaking the same UDP and TCP protocol
+on port 5005 as the wifi enabled firmware. It is good enough for benchmarking
+dpsctl and for working on the GUI without a power supply on the desk.
+
+    python bench/dpsemu.py -b 127.0.0.1 &
+    python dpsctl.py -d 127.0.0.1 -q
+    python dpsctl.py -d tcp:127.0.0.1 -q
+
+Several stand-ins can run side by side on 127.0.0.2, 127.0.0.3 and so on.
+"""
+
+import argparse
+import random
+import socket
+import struct
+import threading
+import time
+
+import benchutil  # noqa: F401 (sets up sys.path)
+import protocol
+import responses
+import uframe
+
+DPS_PORT = 5005
+
+FUNCTIONS = ['cv', 'cc', 'cl', 'funcgen']
+# name, unit, prefix (see unit_name() and prefix_name() in dpsctl.py)
+PARAMETERS = {
+    'cv': [('voltage', 2, -3), ('current', 1, -3)],
+    'cc': [('voltage', 2, -3), ('current', 1, -3)],
+    'cl': [('voltage', 2, -3), ('current', 1, -3)],
+    'funcgen': [('shape', 0, 0), ('frequency', 5, 0), ('amplitude', 2, -3), ('offset', 2, -3)],
+}
+MAX_VALUE = 50000  # mV or mA
+
+
+class dps_state(object):
+    """
+    The settings and readings of the emulated device
+    """
+
+    def __init__(self, v_in=24000, load_ohm=10.0):
+        self.lock = threading.Lock()
+        self.v_in = v_in
+        self.load_ohm = load_ohm
+        self.func = 'cv'
+        self.output_enabled = False
+        self.locked = False
+        self.brightness = 100
+        self.params = {
+            'cv': {'voltage': 3300, 'current': 1000},
+            'cc': {'voltage': 5000, 'current': 500},
+            'cl': {'voltage': 3300, 'current': 1000},
+            'funcgen': {'shape': 0, 'frequency': 1, 'amplitude': 1000, 'offset': 1000},
+        }
+        self.cal = {'A_ADC_K': 1.751, 'A_ADC_C': -1.2, 'A_DAC_K': 0.2366, 'A_DAC_C': 26.5,
+                    'V_ADC_K': 13.0, 'V_ADC_C': -3.2, 'V_DAC_K': 0.0769, 'V_DAC_C': 1.9,
+                    'VIN_ADC_K': 16.9, 'VIN_ADC_C': 37.1}
+
+    def readings(self):
+        """
+        Return (v_out, i_out) in mV and mA
+        """
+        if not self.output_enabled:
+            return 0, 0
+        params = self.params[self.func]
+        v_set = params.get('voltage', 0)
+        i_limit = params.get('current', 0)
+        i_out = int(v_set / self.load_ohm)
+        if i_out > i_limit:
+            # Current limited, voltage drops accordingly
+            return int(i_limit * self.load_ohm), i_limit
+        jitter = random.randint(-2, 2)
+        return max(0, v_set + jitter), max(0, i_out + jitter)
+
+
+def handle_request(state, request):
+    """
+    Handle one unescaped request frame, return the response frame or None
+    """
+    command = request.unpack8()
+    with state.lock:
+        if command == protocol.CMD_QUERY:
+            v_out, i_out = state.readings()
+            return responses.create_query_response(state.v_in, v_out, i_out, state.output_enabled,
+                                                   state.func, state.params[state.func], temp1=31.5)
+        elif command == protocol.CMD_SET_PARAMETERS:
+            statuses = []
+            while not request.eof():
+                key = request.unpack_cstr()
+                value = request.unpack_cstr()
+                params = state.params[state.func]
+                if key not in params:
+                    statuses.append(1)  # unknown parameter
+                    continue
+                try:
+                    value = int(value)
+                except ValueError:
+                    statuses.append(2)
+                    continue
+                if value < 0 or value > MAX_VALUE:
+                    statuses.append(2)  # out of range
+                else:
+                    params[key] = value
+                    statuses.append(0)
+            return responses.create_set_parameters_response(statuses)
+        elif command == protocol.CMD_ENABLE_OUTPUT:
+            state.output_enabled = bool(request.unpack8())
+        elif command == protocol.CMD_SET_FUNCTION:
+            name = request.unpack_cstr()
+            if name not in FUNCTIONS:
+                return responses.create_status_response(command, 0)
+            state.func = name
+            state.output_enabled = False
+        elif command == protocol.CMD_LIST_FUNCTIONS:
+            return responses.create_list_functions_response(FUNCTIONS)
+        elif command == protocol.CMD_LIST_PARAMETERS:
+            return responses.create_list_parameters_response(state.func, PARAMETERS[state.func])
+        elif command == protocol.CMD_VERSION:
+            return responses.create_version_response('emu-boot', 'emu-app')
+        elif command == protocol.CMD_CAL_REPORT:
+            v_out, i_out = state.readings()
+            return responses.create_cal_report(int(v_out / 13), int(state.v_in / 16.9), int(i_out / 1.751),
+                                               int(state.params[state.func].get('current', 0) * 0.2366),
+                                               int(state.params[state.func].get('voltage', 0) * 0.0769),
+                                               state.cal)
+        elif command == protocol.CMD_SET_CALIBRATION:
+            statuses = []
+            while not request.eof():
+                key = request.unpack_cstr()
+                if key == "":
+                    break
+                value = struct.unpack("<f", bytes(request.unpack8() for _ in range(4)))[0]
+                if key in state.cal:
+                    state.cal[key] = value
+                    statuses.append(0)
+                else:
+                    statuses.append(1)
+            return responses.create_set_parameters_response(statuses)
+        elif command == protocol.CMD_LOCK:
+            state.locked = bool(request.unpack8())
+        elif command == protocol.CMD_SET_BRIGHTNESS:
+            state.brightness = request.unpack8()
+        elif command in (protocol.CMD_PING, protocol.CMD_CHANGE_SCREEN, protocol.CMD_CLEAR_CALIBRATION,
+                         protocol.CMD_TEMPERATURE_REPORT):
+            pass
+        else:
+            return None
+    return responses.create_status_response(command)
+
+
+def _respond(state, data, latency_s):
+    request = uframe.uFrame()
+    if request.set_frame(bytearray(data)) < 0:
+        return None
+    response = handle_request(state, request)
+    if response is None:
+        return None
+    if latency_s:
+        time.sleep(latency_s)
+    return bytes(response.get_frame())
+
+
+def udp_server(state, bind, latency_s):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((bind, DPS_PORT))
+    while True:
+        data, addr = sock.recvfrom(1024)
+        response = _respond(state, data, latency_s)
+        if response:
+            sock.sendto(response, addr)
+
+
+def tcp_client(state, conn, latency_s):
+    data = bytearray()
+    with conn:
+        while True:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+            while uframe._EOF in data:
+                end = data.index(uframe._EOF) + 1
+                response = _respond(state, data[:end], latency_s)
+                del data[:end]
+                if response:
+                    conn.sendall(response)
+
+
+def tcp_server(state, bind, latency_s):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((bind, DPS_PORT))
+    sock.listen(5)
+    while True:
+        conn, addr = sock.accept()
+        thread = threading.Thread(target=tcp_client, args=(state, conn, latency_s))
+        thread.daemon = True
+        thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate an OpenDPS device on UDP and TCP port {:d}'.format(DPS_PORT))
+    parser.add_argument('-b', '--bind', default='127.0.0.1', help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help="Added response latency in milliseconds")
+    parser.add_argument('--v-in', type=int, default=24000, help="Emulated input voltage in mV")
+    parser.add_argument('--load', type=float, default=10.0, help="Emulated load in ohm")
+    args = parser.parse_args()
+
+    state = dps_state(args.v_in, args.load)
+    latency_s = args.latency / 1000
+    for server in (udp_server, tcp_server):
+        thread = threading.Thread(target=server, args=(state, args.bind, latency_s))
+        thread.daemon = True
+        thread.start()
+    print("Emulating OpenDPS on {}:{:d} (UDP and TCP)".format(args.bind, DPS_PORT))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2024 Gabriel Tremblay (github.com/gtremblay)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Helpers creating the response frames an OpenDPS device sends back. They
+mirror what the unpack_* functions in protocol.py and handle_response in
+dpsctl.py expect.
+"""
+
+import struct
+
+import benchutil  # noqa: F401 (sets up sys.path)
+import protocol
+from uframe import uFrame
+
+
+def _start(command, status=1):
+    f = uFrame()
+    f.pack8(protocol.CMD_RESPONSE | command)
+    f.pack8(status)
+    return f
+
+
+def _pack_float(f, value):
+    f.pack32(struct.unpack("<I", struct.pack("<f", value))[0])
+
+
+def create_status_response(command, status=1):
+    f = _start(command, status)
+    f.end()
+    return f
+
+
+def create_query_response(v_in, v_out, i_out, output_enabled, cur_func, params,
+                          temp1=None, temp2=None, temp_shutdown=0):
+    f = _start(protocol.CMD_QUERY)
+    f.pack16(v_in)
+    f.pack16(v_out)
+    f.pack16(i_out)
+    f.pack8(output_enabled)
+    f.pack16(0xffff if temp1 is None else int(temp1 * 10))
+    f.pack16(0xffff if temp2 is None else int(temp2 * 10))
+    f.pack8(temp_shutdown)
+    f.pack_cstr(cur_func)
+    for key, value in params.items():
+        f.pack_cstr(key)
+        f.pack_cstr(str(value))
+    f.end()
+    return f
+
+
+def create_cal_report(vout_adc, vin_adc, iout_adc, iout_dac, vout_dac, cal):
+    f = _start(protocol.CMD_CAL_REPORT)
+    for value in (vout_adc, vin_adc, iout_adc, iout_dac, vout_dac):
+        f.pack16(value)
+    for key in ('A_ADC_K', 'A_ADC_C', 'A_DAC_K', 'A_DAC_C', 'V_ADC_K', 'V_ADC_C',
+                'V_DAC_K', 'V_DAC_C', 'VIN_ADC_K', 'VIN_ADC_C'):
+        _pack_float(f, cal[key])
+    f.end()
+    return f
+
+
+def create_version_response(boot_git_hash, app_git_hash):
+    f = _start(protocol.CMD_VERSION)
+    f.pack_cstr(boot_git_hash)
+    f.pack_cstr(app_git_hash)
+    f.end()
+    return f
+
+
+def create_list_functions_response(functions):
+    f = _start(protocol.CMD_LIST_FUNCTIONS)
+    for name in functions:
+        f.pack_cstr(name)
+    f.end()
+    return f
+
+
+def create_list_parameters_response(cur_func, parameters):
+    """
+    parameters is a list of (name, unit, prefix) tuples, unit and prefix as
+    defined by unit_name() and prefix_name() in dpsctl.py
+    """
+    f = _start(protocol.CMD_LIST_PARAMETERS)
+    f.pack_cstr(cur_func)
+    for name, unit, prefix in parameters:
+        f.pack_cstr(name)
+        f.pack8(unit)
+        f.pack8(prefix)
+    f.end()
+    return f
+
+
+def create_set_parameters_response(statuses):
+    f = _start(protocol.CMD_SET_PARAMETERS)
+    for status in statuses:
+        f.pack8(status)
+    f.end()
+    return f
+
+
+def decoded(frame):
+    """
+    Return a uFrame holding the unescaped payload of frame, as dpsctl.py gets
+    it after set_frame()
+    """
+    f = uFrame()
+    res = f.set_frame(bytearray(frame.get_frame()))
+    if res < 0:
+        raise ValueError("invalid frame ({:d})".format(res))
+    return f
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+The MIT License (MIT)
+
+Copyright (c) 2024 Gabriel Tremblay (github.com/gtremblay)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Startup time benchmark for dpsctl.py and dpsctl-gui.py.
+
+Each scenario is started a number of times with 'python -X importtime'. The
+median wall time and the median total import time are reported together with
+the slowest imports of the last run.
+
+    python bench/startup-bench.py -o startup.json
+    python bench/startup-bench.py -d 127.0.0.1 --compare startup.json
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+import benchutil
+
+
+def scenarios(device):
+    """
+    Return a list of (name, argument list passed to python)
+    """
+    s = [
+        ('import dpsctl', ['-c', 'import dpsctl']),
+        ('dpsctl --help', ['dpsctl.py', '--help']),
+        ('dpsctl-gui --help', ['dpsctl-gui.py', '--help']),
+    ]
+    if device:
+        s.append(('dpsctl -q', ['dpsctl.py', '-d', device, '-q']))
+    return s
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of 'python -X importtime'. Return the total import time
+    in microseconds and a list of (cumulative us, module) for every module.
+    """
+    total = 0
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        cumulative = int(parts[1])
+        name = parts[2].rstrip()
+        modules.append((cumulative, name.strip()))
+        if not name.startswith('  '):
+            # Top level import, the ones below it are included in its cumulative time
+            total += cumulative
+    return total, modules
+
+
+def run_scenario(argv, runs):
+    walls = []
+    imports = []
+    modules = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        p = subprocess.run([sys.executable, '-X', 'importtime'] + argv, cwd=benchutil.REPO_ROOT,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        walls.append(time.perf_counter() - start)
+        total, modules = parse_importtime(p.stderr)
+        imports.append(total)
+    return {
+        'wall_ms': statistics.median(walls) * 1000,
+        'min_wall_ms': min(walls) * 1000,
+        'import_ms': statistics.median(imports) / 1000,
+        'runs': runs,
+        'slowest_imports': [[name, us / 1000] for us, name in sorted(modules, reverse=True)[:10]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time benchmark for dpsctl and dpsctl-gui')
+    parser.add_argument('-d', '--device', help="Also time 'dpsctl.py -d DEVICE -q' (e.g. 127.0.0.1 with bench/dpsemu.py running)")
+    parser.add_argument('-n', '--runs', type=int, default=10, help="Number of runs per scenario (default 10)")
+    parser.add_argument('-o', '--output', help="Store the results as JSON in this file")
+    parser.add_argument('-c', '--compare', help="Compare against the results in this JSON file")
+    parser.add_argument('-t', '--threshold', type=float, default=10.0, help="Regression threshold in percent (default 10)")
+    parser.add_argument('-s', '--show-imports', action='store_true', help="List the slowest imports of each scenario")
+    args = parser.parse_args()
+
+    results = {}
+    for name, argv in scenarios(args.device):
+        r = run_scenario(argv, args.runs)
+        results[name] = r
+        print("{:<20} wall {:>8.1f} ms  imports {:>8.1f} ms".format(name, r['wall_ms'], r['import_ms']))
+        if args.show_imports:
+            for module, ms in r['slowest_imports']:
+                print("    {:>8.1f} ms  {}".format(ms, module))
+
+    report = benchutil.make_report('startup', results)
+    if args.output:
+        benchutil.save_report(report, args.output)
+
+    if args.compare:
+        regressions = benchutil.compare_reports(benchutil.load_report(args.compare), report, 'wall_ms', args.threshold)
+        benchutil.print_regressions(regressions, args.threshold, 'ms')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,8 +24,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 This script is a crude front-end for OpenDPS dpsctl.
-It uses stdout redirect to simplify the implementation to the expense
-of a more complex threading management.
+It talks to the device through a dpsctl session and works on the decoded
+responses.
 
 TODO:
     - Enable Lock/Unlock
@@ -33,24 +33,24 @@ TODO:
 """
 
 # Dpsctl related imports
-import copy
 import dpsctl
+import samplelog
 import argparse
-from argparse import Namespace
-from time import sleep
-from typing import Final
+from time import monotonic
 
 # Gui Stuff
 from tkinter import *
 from tkinter import messagebox 
 from tkinter.ttk import *
-from tkextrafont import Font
 
 # General imports
-import io
+import itertools
+import queue
 import sys
+import heapq
 import threading
-from contextlib import redirect_stdout
+import traceback
+from concurrent.futures import Future
 from datetime import datetime
 
 # Hack to show proper taskbar icon under windows
@@ -61,126 +61,217 @@ try:
 except ImportError: 
     pass
 
-# opendps commands
-# Get the args structure dpsctl expect from the command line.
-DPSCTL_NAMESPACE: Final = Namespace(device='', baudrate=9600, brightness=None, scan=False, function=None, list_functions=False, 
-                             parameter=None, list_parameters=False, calibrate=False, calibration_set=None, calibration_report=False, 
-                             calibration_reset=False, enable=None, ping=False, lock=False, unlock=False, query=False, json=False, 
-                             verbose=False, version=False, firmware=None, switch_screen=None, force=False)
-
-# Pre-Defined Commands
-ping_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-ping_cmd.ping = True
-
-status_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-status_cmd.query = True
-
-set_pwr_on_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_pwr_on_cmd.enable = 'on'
-
-set_pwr_off_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_pwr_off_cmd.enable = 'off'
-
-set_cv_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_cv_cmd.function = 'cv'
-
-set_cl_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_cl_cmd.function = 'cl'
-
-set_cc_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_cc_cmd.function = 'cc'
-
-set_funcgen_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_funcgen_cmd.function = 'funcgen'
-
-set_voltage_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_voltage_cmd.parameter = ["voltage="]
-
-set_current_cmd = copy.deepcopy(DPSCTL_NAMESPACE)
-set_current_cmd.parameter = ["current="]
-
 ###################################
 # Gui
 ###################################
-root = Tk()
-icon = PhotoImage(file="assets/app.png")
-root.iconphoto(True, icon)
-root.title("OpenDPS")
-root.geometry("250x200")
-root.resizable(False, False)
+# The widgets are created by build_gui() once the arguments are parsed
+root = None
+selected_mode = None
+running_label = None
+voltage_label = None
+current_label = None
+mode_label = None
+vin_label = None
+err_label = None
+toggle_button = None
+
+# Hands status updates from the poll thread to the Tk main loop
+presenter = None
 
 ## Global variables.
 # Target device
 target_device = ""
 
+# dpsctl.dps_session talking to the target device
+session = None
+
+# device_worker owning the session, every command goes through it
+worker = None
+
+# poll_scheduler pacing update_status
+scheduler = None
+
+# trend_plot showing the history, None unless --plot is given
+plot = None
+
+# samplelog.sample_logger recording the status, None unless --log is given
+sample_log = None
+
 # Running state
 is_running = False
 
-# Currently selected label command
-active_set_command = None
+# Functions of the device, shown as mode radio buttons
+modes = []
 
-# Mode options
-selected_mode = StringVar()
+# Mode radio button labels, other functions are shown in upper case
+MODE_NAMES = {'cv': "CV", 'cl': "CL", 'cc': "CC", 'funcgen': "Func"}
 
-# We need a lock on all commands since the gui thread
-# and status update thread can try to get the same stdout 
-cmd_lock = threading.Lock()
+# The modes shown when the device cannot be asked
+DEFAULT_MODES = ['cv', 'cl', 'cc', 'funcgen']
+
+# Parameter edited in the input box ('voltage' or 'current')
+active_parameter = None
 
 # Generic Error Messagebox
 def show_msgbox_error(title, message):
     messagebox.showerror(title, message) 
 
-# Send a command and read stdout return
-def send_command(command):
-    global target_device
-    with io.StringIO() as buf, redirect_stdout(buf):
-        # dpsctl will call system.exit on error. We want to avoid this.
-        try:
-            command.device = target_device
-            dpsctl.handle_commands(command)
-        except SystemExit:
-            print("ignoring SystemExit")
-        finally:
-            output = buf.getvalue()
-            # Make sure we reset the buffer pointer for the next read to overwrite the previous read
-            buf.seek(0)
-
-    return output
+# Return the functions of the device. The device is always asked for its
+# firmware version, the catalog entry of that build is then used and the
+# functions are only listed for a build the catalog has not seen before.
+def device_modes(session):
+    catalog = dpsctl.function_catalog(dpsctl.catalog_file()).load()
+    try:
+        key, _ = catalog.lookup(session)
+    except (dpsctl.CommsException, SystemExit) as e:
+        print("Could not list functions: {}".format(e))
+        return DEFAULT_MODES
+    try:
+        catalog.save()
+    except (IOError, OSError) as e:
+        print("Warning: could not save function catalog ({})".format(e))
+    # Known modes in their usual order, then whatever else the firmware has
+    return sorted(catalog.functions(key), key=lambda f: DEFAULT_MODES.index(f) if f in DEFAULT_MODES else len(DEFAULT_MODES))
+
+# Run a session method, return its result or None on communication errors
+def send_command(method, *args):
+    # The interfaces call sys.exit on some socket errors. We want to avoid this.
+    try:
+        return method(*args)
+    except (dpsctl.CommsException, SystemExit) as e:
+        print("Command failed: {}".format(e))
+        return None
+    except Exception:
+        # A bug rather than a comm error, but the GUI has to keep polling
+        traceback.print_exc()
+        return None
+
+# Command priorities, lower runs first
+PRIO_URGENT = 0  # power off
+PRIO_USER = 1    # other button presses
+PRIO_POLL = 2    # status polling
+
+class command_pool(object):
+    """
+    Daemon threads running the functions given to submit(). Unlike a
+    ThreadPoolExecutor they do not hold up exiting when a device stops
+    answering.
+    """
+
+    def __init__(self, threads=1):
+        self._queue = queue.Queue()
+        for _ in range(threads):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, fn):
+        self._queue.put(fn)
+
+    def _run(self):
+        while True:
+            self._queue.get()()
+
+class device_worker(object):
+    """
+    Runs every session command, one at a time and in priority order. A
+    command queued by the user runs as soon as the one on the wire
+    completes, ahead of any queued poll. submit() never blocks and returns a
+    Future holding the result of send_command(). A command submitted with
+    replace=True cancels the queued command of the same name, so that eg.
+    the last of several Power ON/OFF clicks wins even though power off runs
+    first.
+
+    The commands run on 'pool', a command_pool which the workers of several
+    devices may share. Without one the worker gets a thread of its own.
+    """
+
+    def __init__(self, session, on_command=None, pool=None):
+        self._session = session
+        self._on_command = on_command  # called after each non poll command
+        self._pool = pool or command_pool()
+        self._lock = threading.Lock()
+        self._jobs = []  # heap of (priority, seq, future, name, args)
+        self._busy = False  # a job of ours is in the pool
+        self._seq = itertools.count()  # keeps commands of equal priority in order
+        self._latest = {}  # name -> Future of the last replaceable command
+        self.commands = 0  # number of commands submitted above poll priority
+
+    def submit(self, priority, name, *args, replace=False):
+        """
+        Queue session.<name>(*args) and return its Future
+        """
+        future = Future()
+        if priority < PRIO_POLL:
+            self.commands += 1
+        if replace:
+            previous = self._latest.get(name)
+            if previous is not None:
+                previous.cancel()  # no-op if already running or done
+            self._latest[name] = future
+        with self._lock:
+            heapq.heappush(self._jobs, (priority, next(self._seq), future, name, args))
+            start = not self._busy
+            self._busy = True
+        if start:
+            self._pool.submit(self._run)
+        return future
+
+    def _run(self):
+        """
+        Run the most urgent job, then hand the pool thread back so
+        other devices get their turn before our next job
+        """
+        with self._lock:
+            job = heapq.heappop(self._jobs)
+            jobs = [job]
+            if job[3] == 'set_parameters':
+                # Send all queued parameter changes in one command, the last value of each wins
+                jobs += [j for j in self._jobs if j[3] == 'set_parameters']
+                self._jobs = [j for j in self._jobs if j[3] != 'set_parameters']
+                heapq.heapify(self._jobs)
+                jobs.sort(key=lambda j: j[1])
+        priority, _, _, name, args = job
+        futures = [j[2] for j in jobs if j[2].set_running_or_notify_cancel()]
+        if len(jobs) > 1:
+            args = ([p for j in jobs if j[2] in futures for p in j[4][0]],)
+        if futures:
+            try:
+                result = send_command(getattr(self._session, name), *args)
+                for future in futures:
+                    future.set_result(result)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            if priority < PRIO_POLL and self._on_command:
+                self._on_command()
+        with self._lock:
+            self._busy = len(self._jobs) > 0
+            if self._busy:
+                self._pool.submit(self._run)
 
 # read the optionbox selected and change mode.
 def change_mode():
     global is_running  # small hack
     # Always turnoff power output before changing mode
-    with cmd_lock:
-        send_command(set_pwr_off_cmd)
-        is_running = False
+    worker.submit(PRIO_URGENT, 'enable_output', 'off', replace=True)
+    is_running = False
 
-    with cmd_lock:
-        if selected_mode.get() == 'cv':
-            send_command(set_cv_cmd)
-        elif selected_mode.get() == 'cl':
-            send_command(set_cl_cmd)
-        elif selected_mode.get() == 'cc':
-            send_command(set_cc_cmd)
-        elif selected_mode.get() == 'funcgen':
-            send_command(set_funcgen_cmd)
+    if selected_mode.get() in modes:
+        return worker.submit(PRIO_USER, 'set_function', selected_mode.get())
 
 # Flip between running state with the same button
 def toggle_running():
     global is_running
     if is_running:
-        with cmd_lock:
-            send_command(set_pwr_off_cmd)
-            is_running = False
+        is_running = False
+        return worker.submit(PRIO_URGENT, 'enable_output', 'off', replace=True)
     else:
-        with cmd_lock:
-            send_command(set_pwr_on_cmd)
-            is_running = True
-
-# Show the input textbox and set the correct target command
-def show_input_frame(input_frame, target_cmd, entry):
-    global active_set_command
-    active_set_command = target_cmd
+        is_running = True
+        return worker.submit(PRIO_USER, 'enable_output', 'on', replace=True)
+
+# Show the input textbox and set the parameter it edits
+def show_input_frame(input_frame, parameter, entry):
+    global active_parameter
+    active_parameter = parameter
     input_frame.grid()
     entry.focus()
 
@@ -196,278 +287,780 @@ def set_target_value(calling_frame, entry):
         val = entry.get()
         intval = int(val)
 
-        # Copy our command template
-        cmd = copy.deepcopy(active_set_command)
-        cmd.parameter[0] += str(intval)
-
         # Send and close the frame
-        with cmd_lock:
-            send_command(cmd)
-            clear_input_hide(calling_frame, entry)
+        future = worker.submit(PRIO_USER, 'set_parameters', ["{}={:d}".format(active_parameter, intval)])
+        clear_input_hide(calling_frame, entry)
+        return future
 
     except ValueError as _:
         messagebox.showerror("Invalid", "Please enter the value in mV or mA (3300)")
        
-# Extract values from dpsctl stdout 
-def extract_status_values(status_text):
-    # Remove the ending \n
-    all_lines = status_text.rstrip('\n')
-
-    # Extract necessary Text from Device Status
-    all_lines = all_lines.replace(' ', '').split('\n')
-
-    # All lines in all modes are in the format "Key:Value"
-    status_vals = dict()  
-    for line in all_lines:
-        split = line.split(':')
-        if len(split) >= 2: # Bug with 'cc' mode.
-            status_vals[split[0]] = split[1]
-
-    # Quick hack to add psu_output and clean-up current mode.
-    func_str = status_vals['Func']
-    if 'on' in func_str:
-        status_vals['psu_output'] = True
+def build_gui():
+    """
+    Create the main window and its widgets. This loads the font and icon
+    files, so it is only done once we know we are going to show something.
+    """
+    global root, selected_mode, running_label, voltage_label, current_label
+    global mode_label, vin_label, err_label, toggle_button
+    from tkextrafont import Font
+
+    root = Tk()
+    icon = PhotoImage(file="assets/app.png")
+    root.iconphoto(True, icon)
+    root.title("OpenDPS")
+    root.geometry("250x200")
+    root.resizable(False, False)
+
+    # Mode options
+    selected_mode = StringVar()
+
+    # Create a frame to contain our status information
+    # This frame sets the size and don't use slaves sizes (grid_propagate)
+    bg_style = Style()
+    bg_style.configure('blackbg.TFrame', foreground="black", background='black')
+    status_frame = Frame(root, width=160, height=140, style='blackbg.TFrame')
+    status_frame.grid_propagate(False)
+    status_frame.grid(row=0, column=1, pady=10)
+    status_frame.columnconfigure(1, weight=1)
+
+    ## This frame contains the mode options
+    options_frame = LabelFrame(root, text="Mode", width=60, height=140)
+    options_frame.grid_propagate(False)
+    options_frame.grid(row=0, column=0, padx=10, pady=10)
+    options_frame.columnconfigure(0, weight=1)
+
+    ## Styles
+    bg_style = Style()
+    bg_style.configure("statuslbl.TLabel", foreground="gray95", background='black')
+    bg_err_style = Style()
+    bg_err_style.configure("status_err_lbl.TLabel", foreground="red", background='black')
+    bg_active_style = Style()
+    bg_active_style.configure("status_active_lbl.TLabel", foreground="palegreen1", background='black')
+
+    running_style = Style()
+    running_style.configure("running.TLabel", foreground="green")
+    stopped_style = Style()
+    stopped_style.configure("stopped.TLabel", foreground="red")
+
+    ## Fonts
+    vi_font = Font(file="assets/MartianMono.ttf", family='Martian', size=32, weight='bold')
+    vin_font = Font(family='Martian', size=10, weight='bold')
+    mode_font = Font(family='Martian', size=14, weight='bold')
+
+    ## Mode radio buttons, one per function of the device
+    for row, function in enumerate(modes):
+        radio = Radiobutton(options_frame,
+                            text=MODE_NAMES.get(function, function.upper()),
+                            variable=selected_mode,
+                            command=change_mode,
+                            state="disabled" if function == 'funcgen' else "normal",  # Unsupported for now
+                            value=function)
+        radio.grid(row=row, sticky='sw')
+
+
+    ## Labels
+    running_label = Label(options_frame, text="Stopped", style='stopped.TLabel')
+    running_label.grid(row=len(modes), pady=5, sticky='s')
+
+    voltage_label = Label(status_frame, text="0.00V", font=vi_font, style='statuslbl.TLabel')
+    voltage_label.grid(row=0, column=0, columnspan=2, padx=5, sticky='se')
+
+    current_label = Label(status_frame, text="0.000A", font=vi_font, style='statuslbl.TLabel')
+    current_label.grid(row=1, column=0, columnspan=2, padx=5, sticky='se')
+
+    mode_label =  Label(status_frame, text="CV", font=mode_font, style='statuslbl.TLabel')
+    mode_label.grid(row=2, column=0, padx=5, sticky='sw')
+
+    vin_label =  Label(status_frame, text="V_in: 0.00V", font=vin_font, style='statuslbl.TLabel')
+    vin_label.grid(row=2, column=1, padx=6, sticky='se')
+
+    err_label =  Label(status_frame, text="", font=vin_font, style='status_err_lbl.TLabel')
+    err_label.grid(row=1, column=0, columnspan=2)
+    err_label.grid_remove() # This saves where it goes
+
+    ## Toggle Button
+    pwr_on_style = Style()
+    pwr_on_style.configure("pwron.TButton", foreground='green')
+    pwr_off_style = Style()
+    pwr_off_style.configure("pwroff.TButton", foreground='red')
+
+    toggle_button = Button(root, text="Power ON", command=toggle_running)
+    toggle_button.grid(row=1, column=0, columnspan=2, padx=3, sticky='s')
+
+    ## Input frame for setting changes.
+    input_frame = Frame(status_frame, width=160, height=30)
+    input_frame.grid_propagate(False)
+    input_frame.grid(row=2, column=0, columnspan=2)
+    input_frame.columnconfigure(0, weight=1)
+    input_frame.grid_remove() # This saves where it goes
+
+    value_entry = Entry(input_frame)
+    value_entry.grid(row=0, column=0, sticky='e')
+
+    set_button = Button(input_frame, text="Set", width=5, command=lambda: set_target_value(input_frame, value_entry))
+    set_button.grid(row=0, column=1, sticky='e')
+
+    cancel_button = Button(input_frame, text="Close", width=5, command=lambda: clear_input_hide(input_frame, value_entry))
+    cancel_button.grid(row=0, column=2, sticky='e')
+
+    # Bind click action to voltage and status labels
+    voltage_label.bind("<Button-1>", lambda e: show_input_frame(input_frame, 'voltage', value_entry))
+    current_label.bind("<Button-1>", lambda e: show_input_frame(input_frame, 'current', value_entry))
+
+    # Bind enter action to Value entry
+    value_entry.bind('<Return>', lambda e: set_target_value(input_frame, value_entry))
+
+
+class status_presenter(object):
+    """
+    Applies views made by status_view() to the widgets. Views are published
+    from any thread and applied on the Tk main loop once it is idle. Only the
+    newest view of a burst is applied, and only the widget options that
+    differ from what is already shown are changed.
+    """
+
+    def __init__(self, tk_root, widgets):
+        self._root = tk_root
+        self._widgets = widgets  # name -> widget, 'selected_mode' is the mode variable
+        self._queue = queue.Queue()
+        self._shown = {}  # name -> options currently shown
+        self._lock = threading.Lock()
+        self._pending = False  # a drain is scheduled
+
+    def publish(self, view):
+        """
+        Thread safe, the view is shown once the main loop is idle
+        """
+        self._queue.put(view)
+        with self._lock:
+            if self._pending:
+                return
+            self._pending = True
+        self._root.after_idle(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            self._pending = False
+        view = None
+        try:
+            while True:
+                view = self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        if view is not None:
+            self._apply(view)
+
+    def _apply(self, view):
+        for name, options in view.items():
+            widget = self._widgets[name]
+            if name == 'selected_mode':
+                # The user changes the mode too, compare with what is selected
+                if widget.get() != options['value']:
+                    widget.set(options['value'])
+                continue
+            shown = self._shown.setdefault(name, {})
+            changed = dict((k, v) for k, v in options.items() if shown.get(k) != v)
+            if not changed:
+                continue
+            shown.update(changed)
+            if 'visible' in changed:
+                widget.grid() if changed.pop('visible') else widget.grid_remove()
+            if changed:
+                widget.config(**changed)
+
+
+def status_view(status):
+    """
+    Return what the widgets should show for a status returned by
+    dps_session.query(), or for a communication error if status is None.
+    The view maps widget names to widget options.
+    """
+    if status is None:
+        t_stamp = '[' + datetime.now().strftime('%H:%M:%S') + ']'
+        return {
+            'voltage_label': {'text': ""},
+            'current_label': {'text': ""},
+            'vin_label': {'text': ""},
+            'mode_label': {'text': ""},
+            'err_label': {'visible': True, 'text': t_stamp + " Comm Error"},
+        }
+
+    func = status['cur_func']
+    params = status['params']
+    view = {
+        'err_label': {'visible': False, 'text': ""},
+        'selected_mode': {'value': func},
+        'toggle_button': {'state': 'disabled' if func == 'cc' else 'enabled'},
+    }
+    if func == 'funcgen':
+        return view # Unsupported for now
+
+    view['vin_label'] = {'text': "V_in: {:.2f}V".format(status['v_in'] / 1000)}
+    if not status['output_enabled']:
+        # Psu not running, show the target voltage and current limit in mV and mA
+        view['running_label'] = {'text': 'Stopped', 'style': 'stopped.TLabel'}
+        view['voltage_label'] = {'text': '{0:.2f}V'.format(int(params.get('voltage', 0)) / 1000), 'style': "statuslbl.TLabel"}
+        view['current_label'] = {'text': '{0:.3f}A'.format(int(params.get('current', 0)) / 1000), 'style': "statuslbl.TLabel"}
+        view['mode_label'] = {'text': func.upper()}
+        view['toggle_button']['text'] = "Power ON"
     else:
-        status_vals['psu_output'] = False
-
-    # clean up current function
-    status_vals['Func'] = func_str[:func_str.find('(')]
-    
-    return status_vals
-
-
-# Create a frame to contain our status information
-# This frame sets the size and don't use slaves sizes (grid_propagate)
-bg_style = Style()
-bg_style.configure('blackbg.TFrame', foreground="black", background='black')
-status_frame = Frame(root, width=160, height=140, style='blackbg.TFrame')
-status_frame.grid_propagate(False)
-status_frame.grid(row=0, column=1, pady=10)
-status_frame.columnconfigure(1, weight=1)
-
-## This frame contains the mode options
-options_frame = LabelFrame(root, text="Mode", width=60, height=140)
-options_frame.grid_propagate(False)
-options_frame.grid(row=0, column=0, padx=10, pady=10)
-options_frame.columnconfigure(0, weight=1)
-
-## Styles
-bg_style = Style()
-bg_style.configure("statuslbl.TLabel", foreground="gray95", background='black')
-bg_err_style = Style()
-bg_err_style.configure("status_err_lbl.TLabel", foreground="red", background='black')
-bg_active_style = Style()
-bg_active_style.configure("status_active_lbl.TLabel", foreground="palegreen1", background='black')
-
-running_style = Style()
-running_style.configure("running.TLabel", foreground="green")
-stopped_style = Style()
-stopped_style.configure("stopped.TLabel", foreground="red")
-
-## Fonts
-vi_font = Font(file="assets/MartianMono.ttf", family='Martian', size=32, weight='bold')
-vin_font = Font(family='Martian', size=10, weight='bold')
-mode_font = Font(family='Martian', size=14, weight='bold')
-
-## Mode radio buttonss
-cv_radio = Radiobutton(options_frame, 
-                    text="CV",
-                    variable=selected_mode, 
-                    command=change_mode,
-                    value="cv")
-cv_radio.grid(row=0, sticky='sw')
-
-cl_radio = Radiobutton(options_frame, 
-                    text="CL",
-                    variable=selected_mode, 
-                    command=change_mode, 
-                    value="cl")
-cl_radio.grid(row=1, sticky='sw')
-
-cc_radio = Radiobutton(options_frame, 
-                    text="CC",
-                    variable=selected_mode, 
-                    command=change_mode,
-                    value="cc")
-cc_radio.grid(row=2, sticky='sw')
-
-func_radio = Radiobutton(options_frame, 
-                    text="Func",
-                    variable=selected_mode, 
-                    command=change_mode,
-                    state="disabled",
-                    value="funcgen")
-func_radio.grid(row=3, sticky='sw')
-
-
-## Labels
-running_label = Label(options_frame, text="Stopped", style='stopped.TLabel')
-running_label.grid(row=4, pady=5, sticky='s')
-
-voltage_label = Label(status_frame, text="0.00V", font=vi_font, style='statuslbl.TLabel')
-voltage_label.grid(row=0, column=0, columnspan=2, padx=5, sticky='se')
-
-current_label = Label(status_frame, text="0.000A", font=vi_font, style='statuslbl.TLabel')
-current_label.grid(row=1, column=0, columnspan=2, padx=5, sticky='se')
-
-mode_label =  Label(status_frame, text="CV", font=mode_font, style='statuslbl.TLabel')
-mode_label.grid(row=2, column=0, padx=5, sticky='sw')
-
-vin_label =  Label(status_frame, text="V_in: 0.00V", font=vin_font, style='statuslbl.TLabel')
-vin_label.grid(row=2, column=1, padx=6, sticky='se')
-
-err_label =  Label(status_frame, text="", font=vin_font, style='status_err_lbl.TLabel')
-err_label.grid(row=1, column=0, columnspan=2)
-err_label.grid_remove() # This saves where it goes
-
-## Toggle Button
-pwr_on_style = Style()
-pwr_on_style.configure("pwron.TButton", foreground='green')
-pwr_off_style = Style()
-pwr_off_style.configure("pwroff.TButton", foreground='red')
-
-toggle_button = Button(root, text="Power ON", command=toggle_running)
-toggle_button.grid(row=1, column=0, columnspan=2, padx=3, sticky='s')
-
-## Input frame for setting changes.
-input_frame = Frame(status_frame, width=160, height=30)
-input_frame.grid_propagate(False)
-input_frame.grid(row=2, column=0, columnspan=2)
-input_frame.columnconfigure(0, weight=1)
-input_frame.grid_remove() # This saves where it goes
-
-value_entry = Entry(input_frame)
-value_entry.grid(row=0, column=0, sticky='e')
-
-set_button = Button(input_frame, text="Set", width=5, command=lambda: set_target_value(input_frame, value_entry))
-set_button.grid(row=0, column=1, sticky='e')
-
-cancel_button = Button(input_frame, text="Close", width=5, command=lambda: clear_input_hide(input_frame, value_entry))
-cancel_button.grid(row=0, column=2, sticky='e')
-
-# Bind click action to voltage and status labels
-voltage_label.bind("<Button-1>", lambda e: show_input_frame(input_frame, set_voltage_cmd, value_entry))
-current_label.bind("<Button-1>", lambda e: show_input_frame(input_frame, set_current_cmd, value_entry))
-
-# Bind enter action to Value entry
-value_entry.bind('<Return>', lambda e: set_target_value(input_frame, value_entry))
-
-# Gui update mainloop.
+        # Psu is running, show the output voltage and current
+        view['running_label'] = {'text': 'Running', 'style': 'running.TLabel'}
+        view['voltage_label'] = {'text': "{:.2f}V".format(status['v_out'] / 1000), 'style': "status_active_lbl.TLabel"}
+        view['current_label'] = {'text': "{:.3f}A".format(status['i_out'] / 1000), 'style': "status_active_lbl.TLabel"}
+        # Show CVCL when running in CL
+        view['mode_label'] = {'text': "CVCL" if func == 'cl' else func.upper()}
+        view['toggle_button']['text'] = "Power OFF"
+    return view
+
+
+# Default polling rate while the output is on or readings change (Hz)
+POLL_HZ = 2.5
+# Poll this many times slower when the output is off and nothing changes
+IDLE_DIVISOR = 4
+# Keep polling fast for this many polls after a change
+SETTLE_POLLS = 3
+# Polling interval while the window is minimized (s)
+HIDDEN_INTERVAL_S = 5.0
+
+class poll_scheduler(object):
+    """
+    Decides when update_status polls next. Deadlines are kept on the
+    monotonic clock so the time spent talking to the device does not add
+    to the interval, and a late poll does not cause a burst of catch up
+    polls. kick() makes the next poll happen right away, eg. to show the
+    result of a button press.
+    """
+
+    def __init__(self, poll_hz=POLL_HZ):
+        self.fast_s = 1.0 / poll_hz
+        self.idle_s = self.fast_s * IDLE_DIVISOR
+        self.visible = True
+        self._settle = SETTLE_POLLS
+        self._last = None
+        self._deadline = monotonic()
+        self._wakeup = threading.Event()
+
+    def kick(self):
+        self._wakeup.set()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        if visible:
+            self.kick()
+
+    def interval(self, status):
+        """
+        Return the polling interval following this status (None on comm errors)
+        """
+        key = None
+        if status is not None:
+            key = (status['output_enabled'], status['cur_func'], status['v_in'] // 100,
+                   status['v_out'], status['i_out'], tuple(sorted(status['params'].items())))
+        if key != self._last:
+            self._last = key
+            self._settle = SETTLE_POLLS
+        elif self._settle > 0:
+            self._settle -= 1
+        if not self.visible:
+            return HIDDEN_INTERVAL_S
+        if status is not None and (status['output_enabled'] or self._settle > 0):
+            return self.fast_s
+        return self.idle_s
+
+    def wait(self, status):
+        """
+        Block until the next poll is due
+        """
+        self._deadline += self.interval(status)
+        now = monotonic()
+        if self._deadline < now:
+            # Running late, start over from now rather than catching up
+            self._deadline = now
+        self._wakeup.wait(self._deadline - now)
+        if self._wakeup.is_set():
+            self._wakeup.clear()
+            self._deadline = monotonic()
+
+# Number of samples kept for the trend plot, 4 hours at the default poll rate
+PLOT_HISTORY = 36000
+# Trend plot refresh interval (ms)
+PLOT_MS = 250
+# Time axis spans (s), the shortest one holding all samples is shown
+PLOT_SPANS = (60, 5 * 60, 15 * 60, 60 * 60, 4 * 60 * 60, 24 * 60 * 60)
+
+# Samples reduced to one minimum and maximum for the plot once there are many
+COARSE_STRIDE = 16
+
+class sample_ring(object):
+    """
+    Fixed size history of (monotonic time, V_out, I_out) in numpy arrays.
+    add() may be called from any thread, once full the oldest samples are
+    overwritten so memory use does not grow however long the GUI runs.
+
+    Alongside the samples, every COARSE_STRIDE of them are reduced to the
+    minimum and maximum of V, I and P as they are added, so plotting a full
+    history does not mean going through every sample again.
+    """
+
+    def __init__(self, np, capacity=PLOT_HISTORY):
+        self._np = np
+        self._data = np.zeros((3, capacity))
+        self._next = 0
+        self._count = 0
+        # Time, then minimum and maximum of V, I and P of each bucket
+        self._coarse = np.zeros((7, max(1, capacity // COARSE_STRIDE)))
+        self._coarse_next = 0
+        self._coarse_count = 0
+        self._bucket = 0  # index of the bucket being filled
+        self._bucket_samples = 0
+        self._lock = threading.Lock()
+        self.added = 0  # number of samples ever added
+
+    def add(self, t, v_out, i_out):
+        p_out = v_out * i_out
+        with self._lock:
+            self._data[:, self._next] = (t, v_out, i_out)
+            self._next = (self._next + 1) % self._data.shape[1]
+            self._count = min(self._count + 1, self._data.shape[1])
+            if self._bucket_samples == 0:
+                self._bucket = self._coarse_next
+                self._coarse[:, self._bucket] = (t, v_out, v_out, i_out, i_out, p_out, p_out)
+                self._coarse_next = (self._coarse_next + 1) % self._coarse.shape[1]
+                self._coarse_count = min(self._coarse_count + 1, self._coarse.shape[1])
+            else:
+                bucket = self._coarse[:, self._bucket]
+                for row, value in ((1, v_out), (3, i_out), (5, p_out)):
+                    bucket[row] = min(bucket[row], value)
+                    bucket[row + 1] = max(bucket[row + 1], value)
+            self._bucket_samples = (self._bucket_samples + 1) % COARSE_STRIDE
+            self.added += 1
+
+    def plot_data(self, limit):
+        """
+        Return the times and the V, I and P series, oldest first. Up to
+        'limit' samples are returned as they are, beyond that the minimum and
+        maximum of each bucket of COARSE_STRIDE samples, both at the time of
+        the first sample in the bucket.
+        """
+        np = self._np
+        with self._lock:
+            if self._count <= limit:
+                t, v, i = self._data[:, :self._count].copy()
+                return t, [v, i, v * i]
+            if self._coarse_count < self._coarse.shape[1]:
+                coarse = self._coarse[:, :self._coarse_count].copy()
+            else:
+                coarse = np.concatenate((self._coarse[:, self._coarse_next:],
+                                         self._coarse[:, :self._coarse_next]), axis=1)
+        return np.repeat(coarse[0], 2), [coarse[row:row + 2].T.ravel() for row in (1, 3, 5)]
+
+def minmax_decimate(np, x, y, buckets):
+    """
+    Reduce x, y to the minimum and maximum of each of 'buckets' equally
+    sized buckets, in time order. Spikes survive, and the number of points
+    drawn depends on the screen width only. The oldest samples left over
+    when len(x) is not a multiple of 'buckets' are dropped.
+    """
+    n = len(x)
+    if n <= 2 * buckets:
+        return x, y
+    size = n // buckets
+    xs = x[n - size * buckets:].reshape(buckets, size)
+    ys = y[n - size * buckets:].reshape(buckets, size)
+    lo = ys.argmin(axis=1)
+    hi = ys.argmax(axis=1)
+    first = np.minimum(lo, hi)
+    second = np.maximum(lo, hi)
+    rows = np.arange(buckets)
+    out_x = np.empty(2 * buckets)
+    out_y = np.empty(2 * buckets)
+    out_x[0::2] = xs[rows, first]
+    out_x[1::2] = xs[rows, second]
+    out_y[0::2] = ys[rows, first]
+    out_y[1::2] = ys[rows, second]
+    return out_x, out_y
+
+class trend_plot(object):
+    """
+    Voltage, current and power over time, drawn on a matplotlib canvas.
+    The axes are only redrawn when a time span or value range changes,
+    otherwise the lines are blitted onto the cached background.
+    """
+
+    def __init__(self, np, canvas, figure):
+        self._np = np
+        self._canvas = canvas
+        self._figure = figure
+        self.ring = sample_ring(np)
+        self._drawn = 0  # ring.added at the last redraw
+        self._axes = figure.subplots(3, 1, sharex=True)
+        self._lines = []
+        for axes, label, color in zip(self._axes, ("V", "A", "W"), ("tab:green", "tab:orange", "tab:red")):
+            axes.set_ylabel(label)
+            axes.grid(True, alpha=0.3)
+            line, = axes.plot([], [], color=color, linewidth=1, animated=True)
+            self._lines.append(line)
+        self._axes[-1].set_xlabel("seconds ago")
+        self._span = None
+        self._background = None
+        figure.tight_layout()
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def add(self, status):
+        if status is not None and 'v_out' in status:
+            self.ring.add(monotonic(), status['v_out'] / 1000, status['i_out'] / 1000)
+
+    def _on_draw(self, event):
+        self._background = self._canvas.copy_from_bbox(self._figure.bbox)
+
+    def _set_limits(self, series, span):
+        """
+        Update the axis limits, return True if the axes need a full redraw
+        """
+        redraw = span != self._span
+        if redraw:
+            self._span = span
+            self._axes[0].set_xlim(-span, 0)
+        for axes, (_, y) in zip(self._axes, series):
+            low, high = axes.get_ylim()
+            top = float(y.max()) if len(y) else 0.0
+            if top > high or top < high / 4:
+                # Rescale with some headroom, and shrink when values drop a lot
+                limits = (0.0, max(top * 1.25, 0.01))
+                if limits != (low, high):
+                    axes.set_ylim(*limits)
+                    redraw = True
+        return redraw
+
+    def refresh(self):
+        """
+        Redraw if there are new samples, called from the Tk main loop
+        """
+        if self.ring.added == self._drawn:
+            return
+        self._drawn = self.ring.added
+        np = self._np
+        buckets = max(1, int(self._axes[0].bbox.width))
+        t, ys = self.ring.plot_data(2 * buckets)
+        t = t - monotonic()
+        age = -t[0] if len(t) else 0
+        span = next((s for s in PLOT_SPANS if s >= age), PLOT_SPANS[-1])
+        series = [minmax_decimate(np, t, y, buckets) for y in ys]
+        for line, (x, y) in zip(self._lines, series):
+            line.set_data(x, y)
+        if self._set_limits(series, span) or self._background is None:
+            self._canvas.draw()  # calls _on_draw which saves the background
+        self._canvas.restore_region(self._background)
+        for axes, line in zip(self._axes, self._lines):
+            axes.draw_artist(line)
+        self._canvas.blit(self._figure.bbox)
+
+def build_plot(tk_root):
+    """
+    Create the trend plot below the status display. Return None if numpy
+    or matplotlib is not installed.
+    """
+    try:
+        import numpy as np
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    except ImportError as e:
+        print("Trend plot disabled, missing dependency: {}".format(e))
+        return None
+    figure = Figure(figsize=(4, 3), dpi=80)
+    canvas = FigureCanvasTkAgg(figure, master=tk_root)
+    canvas.get_tk_widget().grid(row=2, column=0, columnspan=2, padx=5, pady=5)
+    tk_root.geometry("")  # grow the window to fit the plot
+    return trend_plot(np, canvas, figure)
+
+def refresh_plot():
+    plot.refresh()
+    root.after(PLOT_MS, refresh_plot)
+
+# Panels per row in the dashboard
+DASHBOARD_COLUMNS = 4
+# Threads shared by all dashboard devices, at most one command per device runs at a time
+DASHBOARD_THREADS = 8
+
+class device_panel(object):
+    """
+    The status display and controls of one device in the dashboard. It
+    works like the single device window, with state of its own instead of
+    the module globals.
+    """
+
+    def __init__(self, parent, device, pool, fonts, poll_hz=POLL_HZ):
+        self.device = device
+        self.session = dpsctl.dps_session(dpsctl.create_comms(argparse.Namespace(device=device, baudrate=9600)))
+        self.scheduler = poll_scheduler(poll_hz)
+        self.worker = device_worker(self.session, pool=pool)
+        self.is_running = False
+        self.frame = LabelFrame(parent, text=device)
+        self.frame.columnconfigure(1, weight=1)
+
+        vi_font, small_font = fonts
+        self.selected_mode = StringVar()
+        widgets = {'selected_mode': self.selected_mode}
+        status_frame = Frame(self.frame, style='blackbg.TFrame')
+        status_frame.grid(row=0, column=0, columnspan=2, sticky='nsew', padx=5, pady=5)
+        status_frame.columnconfigure(1, weight=1)
+        for row, name, text in ((0, 'voltage_label', "0.00V"), (1, 'current_label', "0.000A")):
+            widgets[name] = Label(status_frame, text=text, font=vi_font, style='statuslbl.TLabel')
+            widgets[name].grid(row=row, column=0, columnspan=2, padx=5, sticky='e')
+        widgets['mode_label'] = Label(status_frame, text="CV", font=small_font, style='statuslbl.TLabel')
+        widgets['mode_label'].grid(row=2, column=0, padx=5, sticky='w')
+        widgets['vin_label'] = Label(status_frame, text="V_in: 0.00V", font=small_font, style='statuslbl.TLabel')
+        widgets['vin_label'].grid(row=2, column=1, padx=5, sticky='e')
+        widgets['err_label'] = Label(status_frame, text="", font=small_font, style='status_err_lbl.TLabel')
+        widgets['err_label'].grid(row=1, column=0, columnspan=2)
+        widgets['err_label'].grid_remove()
+
+        mode_box = Combobox(self.frame, textvariable=self.selected_mode, values=device_modes(self.session),
+                            state='readonly', width=5)
+        mode_box.grid(row=1, column=0, padx=5, pady=5, sticky='w')
+        mode_box.bind('<<ComboboxSelected>>', lambda e: self.change_mode())
+        widgets['running_label'] = Label(self.frame, text="Stopped", style='stopped.TLabel')
+        widgets['running_label'].grid(row=1, column=1, padx=5, sticky='e')
+        widgets['toggle_button'] = Button(self.frame, text="Power ON", command=self.toggle_running)
+        widgets['toggle_button'].grid(row=2, column=0, columnspan=2, pady=5)
+        self.presenter = status_presenter(parent, widgets)
+
+    def change_mode(self):
+        self.worker.submit(PRIO_URGENT, 'enable_output', 'off', replace=True)
+        self.is_running = False
+        return self.worker.submit(PRIO_USER, 'set_function', self.selected_mode.get())
+
+    def toggle_running(self):
+        self.is_running = not self.is_running
+        if self.is_running:
+            return self.worker.submit(PRIO_USER, 'enable_output', 'on', replace=True)
+        return self.worker.submit(PRIO_URGENT, 'enable_output', 'off', replace=True)
+
+    def show(self, status):
+        if status is not None and status['cur_func'] != 'funcgen':
+            self.is_running = bool(status['output_enabled'])
+        self.presenter.publish(status_view(status))
+
+class dashboard_poller(object):
+    """
+    Polls every dashboard panel from one thread. The polls themselves run
+    on the panels' device workers, which share a command_pool, so a slow
+    device does not hold up the others. Each panel is polled at the rate
+    its poll_scheduler asks for, kept as deadlines in a heap.
+    """
+
+    def __init__(self, panels):
+        self._panels = panels
+        self._events = queue.Queue()  # (panel index, deadline, poll done) from other threads
+        self._due = [None] * len(panels)  # the deadline each panel is waiting for
+        self._polling = [False] * len(panels)
+        for i, panel in enumerate(panels):
+            panel.worker._on_command = lambda i=i: self.kick(i)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def kick(self, index):
+        """
+        Poll a panel right away, thread safe
+        """
+        self._events.put((index, monotonic(), False))
+
+    def set_visible(self, visible):
+        for i, panel in enumerate(self._panels):
+            panel.scheduler.set_visible(visible)
+            if visible:
+                self.kick(i)
+
+    def _poll(self, index, deadline):
+        panel = self._panels[index]
+        commands = panel.worker.commands
+        def done(future):
+            # The next poll is always scheduled, or the panel would never be polled again
+            next_poll = monotonic()
+            try:
+                status = future.result()
+            except Exception:
+                traceback.print_exc()
+                status = None
+            try:
+                if panel.worker.commands == commands:
+                    panel.show(status)
+                    # Schedule from the deadline so the rate does not drift, unless running late
+                    next_poll = max(deadline + panel.scheduler.interval(status), monotonic())
+                # else a command was queued meanwhile, this status may predate it so poll again now
+            finally:
+                self._events.put((index, next_poll, True))
+        self._polling[index] = True
+        panel.worker.submit(PRIO_POLL, 'query').add_done_callback(done)
+
+    def _run(self):
+        heap = []
+        for i in range(len(self._panels)):
+            self.kick(i)
+        while True:
+            timeout = max(0, heap[0][0] - monotonic()) if heap else None
+            try:
+                index, deadline, done = self._events.get(timeout=timeout)
+                if done:
+                    self._polling[index] = False
+                elif self._polling[index] or (self._due[index] is not None and self._due[index] <= deadline):
+                    continue  # The poll on its way or the one due first will do
+                self._due[index] = deadline
+                heapq.heappush(heap, (deadline, index))
+                continue
+            except queue.Empty:
+                pass
+            deadline, index = heapq.heappop(heap)
+            if deadline != self._due[index] or self._polling[index]:
+                continue  # Superseded by a kick, or a poll is on its way
+            self._poll(index, deadline)
+
+def build_dashboard(devices, poll_hz=POLL_HZ):
+    """
+    Create the main window with one device_panel per device
+    """
+    global root
+    from tkextrafont import Font
+
+    root = Tk()
+    icon = PhotoImage(file="assets/app.png")
+    root.iconphoto(True, icon)
+    root.title("OpenDPS ({:d} devices)".format(len(devices)))
+
+    Style().configure('blackbg.TFrame', foreground="black", background='black')
+    Style().configure("statuslbl.TLabel", foreground="gray95", background='black')
+    Style().configure("status_err_lbl.TLabel", foreground="red", background='black')
+    Style().configure("status_active_lbl.TLabel", foreground="palegreen1", background='black')
+    Style().configure("running.TLabel", foreground="green")
+    Style().configure("stopped.TLabel", foreground="red")
+    fonts = (Font(file="assets/MartianMono.ttf", family='Martian', size=20, weight='bold'),
+             Font(family='Martian', size=9, weight='bold'))
+
+    pool = command_pool(min(len(devices), DASHBOARD_THREADS))
+    panels = []
+    for i, device in enumerate(devices):
+        panel = device_panel(root, device, pool, fonts, poll_hz)
+        panel.frame.grid(row=i // DASHBOARD_COLUMNS, column=i % DASHBOARD_COLUMNS, padx=5, pady=5, sticky='nsew')
+        panels.append(panel)
+    return panels
+
+def discover_devices(timeout):
+    """
+    Return the addresses of the OpenDPS devices announcing themselves on
+    the local network within timeout seconds
+    """
+    print("Scanning for OpenDPS devices...")
+    devices = sorted(set(d['source'] for d in dpsctl.uhej_discover(timeout=timeout)))
+    print("Found {}".format(", ".join(devices) if devices else "none"))
+    return devices
+
+# Status poll loop, runs in its own thread
 def update_status():
-    global selected_mode, is_running
+    global is_running
     while True:
-        # Fetch status from device
-        with cmd_lock:
-            output = send_command(status_cmd) 
-
-        # Show error if we don't get the proper text
-        if "Func" not in output:
-            t_stamp = '[' + datetime.now().strftime('%H:%M:%S') + ']'
-            voltage_label.config(text="")
-            current_label.config(text="")
-            vin_label.config(text="")
-            mode_label.config(text="")
-            err_label.grid()
-            err_label.config(text = t_stamp + " Comm Error")    
-        else:
-            # Clear Error if present
-            err_label.grid_remove()
-            err_label.config(text="")
-
-            # Extract All status values
-            status_values = extract_status_values(output)
-
-            # Exit if we're in funcgen mode for now.
-            if status_values['Func'] == 'funcgen':
-                selected_mode.set('funcgen')
-                toggle_button.config(state='enabled')
-                continue # Unsupported for now
-            elif status_values['Func'] == 'cv':
-                selected_mode.set('cv')
-                cv_radio.configure(value='cv')
-                toggle_button.config(state='enabled')
-            elif status_values['Func'] == 'cl':
-                selected_mode.set('cl')
-                toggle_button.config(state='enabled')
-            elif status_values['Func'] == 'cc':
-                selected_mode.set('cc')
-                toggle_button.config(state='disabled')
-
-            # Target voltage in mV (3000 = 3v)
-            target_voltage = status_values['voltage']
-            fmt_target_voltage = '{0:.2f}V'.format(int(target_voltage)/1000)
-
-            # Target current limit in mA (1500 = 1.5A)
-            target_current_limit = status_values['current']
-            fmt_target_current_limit = '{0:.3f}A'.format(int(target_current_limit)/1000)
-
-            # DPS input voltage in Volt (With V included)
-            dps_input_voltage = status_values['V_in']
-
-            # Voltage output in Volts (With V included)
-            output_voltage = status_values['V_out']
-
-            # Current output in Amps (With A included)
-            output_current = status_values['I_out']
-
-            # Display output
-            vin_label.config(text="V_in: " + dps_input_voltage)
-
-            # Psu is Disabled
-            if not status_values['psu_output']:
-                # Psu not running
-                is_running = False
-                running_label.config(text='Stopped', style='stopped.TLabel')
-
-                # Voltage
-                voltage_label.config(text=fmt_target_voltage, style="statuslbl.TLabel")
-                current_label.config(text=fmt_target_current_limit, style="statuslbl.TLabel")
-
-                # Mode
-                if status_values['Func'] == 'cl':
-                    if mode_label.cget('text') != 'CL':
-                        mode_label.config(text="CL")
-                else:
-                    mode_label.config(text=status_values['Func'].upper())
-
-                # Enable Button
-                toggle_button.config(text="Power ON")
-            else:
-                # Psu is running
-                is_running = True
-                running_label.config(text='Running', style='running.TLabel')
-
-                # Voltage
-                voltage_label.config(text=output_voltage, style="status_active_lbl.TLabel")
+        # Fetch status from device, queued behind any user command
+        commands = worker.commands
+        try:
+            status = worker.submit(PRIO_POLL, 'query').result()
+        except Exception:
+            traceback.print_exc()
+            status = None
+        if worker.commands != commands:
+            # A command was queued meanwhile, this status may predate it
+            continue
+
+        if status is not None and status['cur_func'] != 'funcgen':
+            is_running = bool(status['output_enabled'])
+        presenter.publish(status_view(status))
+        if plot is not None:
+            plot.add(status)
+        if sample_log is not None and status is not None:
+            sample_log.log(status)
 
-                # Mode (Show CVCL when running in CL)
-                if status_values['Func'] == 'cl':
-                    current_label.config(text=output_current, style="status_active_lbl.TLabel")
-                    mode_label.config(text="CVCL")
-                else:
-                    current_label.config(text=output_current, style="status_active_lbl.TLabel")
-                    mode_label.config(text=status_values['Func'].upper())
+        # Give some breath to the controller
+        scheduler.wait(status)
 
-                # Enable Button
-                toggle_button.config(text="Power OFF")
 
-        # Give some breath to the controller
-        sleep(0.4)
+def run_dashboard(devices, poll_hz=POLL_HZ):
+    panels = build_dashboard(devices, poll_hz)
+    poller = dashboard_poller(panels)
+    root.bind('<Unmap>', lambda e: e.widget is root and poller.set_visible(False))
+    root.bind('<Map>', lambda e: e.widget is root and poller.set_visible(True))
+    poller.start()
+    root.mainloop()
 
 
 def main():
-    global target_device
+    global target_device, session, worker, scheduler, presenter, plot, sample_log, modes
 
     parser = argparse.ArgumentParser(description="Process device argument")
-    parser.add_argument('-d', '--device', required=True, help="Specify the device")
+    parser.add_argument('-d', '--device', nargs='+', default=[],
+                        help="Specify the device, several devices open the dashboard")
+    parser.add_argument('-S', '--scan', action='store_true', help="Add the OpenDPS wifi devices found on the network, opens the dashboard")
+    parser.add_argument('--scan-timeout', type=float, default=3.0, help="Scan for this many seconds (default 3)")
+    parser.add_argument('--poll-hz', type=float, default=POLL_HZ,
+                        help="Status polling rate while the output is on (default {})".format(POLL_HZ))
+    parser.add_argument('--plot', action='store_true', help="Show a voltage, current and power trend plot")
+    parser.add_argument('--log', metavar='FILE', help="Log the status to FILE, as CSV or as binary records if FILE ends with .bin")
+    parser.add_argument('--log-max-mb', type=float, default=0, help="Rotate the log file when it grows past this many MB (default never)")
+    parser.add_argument('--log-backups', type=int, default=5, help="Number of rotated log files kept (default 5)")
     try:
         args = parser.parse_args()
-        target_device = args.device.replace(' ','')
-        print(f"Device selected: {args.device}")
+        devices = [d.replace(' ','') for d in args.device]
+        if args.scan:
+            devices += [d for d in discover_devices(args.scan_timeout) if d not in devices]
+        if not devices:
+            parser.error("no device given or found, use -d")
+        print(f"Device selected: {', '.join(devices)}")
     except argparse.ArgumentError as e:
         print(f"Error: {e}")
         sys.exit(1)
 
+    if args.poll_hz <= 0:
+        parser.error("--poll-hz must be positive")
+    if len(devices) > 1 or args.scan:
+        if args.plot or args.log:
+            parser.error("--plot and --log need a single device")
+        run_dashboard(devices, args.poll_hz)
+        return
+
+    target_device = devices[0]
+
+    if args.log:
+        try:
+            sample_log = samplelog.sample_logger(args.log, max_bytes=int(args.log_max_mb * 1024 * 1024),
+                                                 backups=args.log_backups)
+        except (ValueError, IOError, OSError) as e:
+            parser.error(str(e))
+
+    session = dpsctl.dps_session(dpsctl.create_comms(argparse.Namespace(device=target_device, baudrate=9600)))
+    scheduler = poll_scheduler(args.poll_hz)
+    worker = device_worker(session, on_command=scheduler.kick)
+    modes = device_modes(session)
+
+    build_gui()
+    presenter = status_presenter(root, {
+        'selected_mode': selected_mode,
+        'running_label': running_label,
+        'voltage_label': voltage_label,
+        'current_label': current_label,
+        'mode_label': mode_label,
+        'vin_label': vin_label,
+        'err_label': err_label,
+        'toggle_button': toggle_button,
+    })
+
+    if args.plot:
+        plot = build_plot(root)
+        if plot is not None:
+            root.after(PLOT_MS, refresh_plot)
+
+    # Poll slowly while minimized
+    root.bind('<Unmap>', lambda e: e.widget is root and scheduler.set_visible(False))
+    root.bind('<Map>', lambda e: e.widget is root and scheduler.set_visible(True))
+
     # Start our status update loop
     thread = threading.Thread(target=update_status, daemon=True)
     thread.start()
@@ -475,6 +1068,9 @@ def main():
     # Show the gui
     root.mainloop()
 
+    if sample_log is not None:
+        sample_log.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
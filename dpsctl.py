@@ -39,18 +39,16 @@ from __future__ import print_function
 from __future__ import division
 
 import argparse
-import codecs
-import json
 import os
 import socket
 import sys
-import threading
 import time
 import math
 
+# Transport and feature specific modules (pyserial, crc16, json, threading,
+# uhej, matplotlib) are imported where they are used so that a plain query
+# over UDP does not pay for them at startup.
 calibration_debug_plotting = False  # Change this to True to enable plotting of the calibration graphs during dpsctl -C
-if calibration_debug_plotting:
-    import matplotlib.pyplot as plt
 
 import protocol
 import uframe
@@ -59,24 +57,27 @@ from protocol import (create_cmd, create_enable_output, create_lock, create_set_
                       create_upgrade_data, create_upgrade_start, create_change_screen,
                       unpack_cal_report, unpack_query_response, unpack_version_response)
 
-try:
-    import crc16
-except ImportError:
-    print("Missing dependency crc16:")
-    print(" sudo pip{} install crc16"
-          .format("3" if sys.version_info.major == 3 else ""))
-    raise SystemExit()
-try:
-    import serial
-except ImportError:
-    print("Missing dependency pyserial:")
-    print(" sudo pip{} install pyserial"
-          .format("3" if sys.version_info.major == 3 else ""))
-    raise SystemExit()
-
 parameters = []
 
 
+def import_dependency(module_name, package_name):
+    """
+    Import a third party module the first time it is needed, tell the user
+    how to install it if it is missing
+    """
+    try:
+        return __import__(module_name)
+    except ImportError:
+        print("Missing dependency {}:".format(package_name))
+        print(" sudo pip{} install {}"
+              .format("3" if sys.version_info.major == 3 else "", package_name))
+        raise SystemExit()
+
+
+class CommsException(Exception):
+    pass
+
+
 class comm_interface(object):
     """
     An abstract class that describes a communication interface
@@ -118,13 +119,14 @@ class tty_interface(comm_interface):
 
     def open(self):
         if not self._port_handle:
+            serial = import_dependency('serial', 'pyserial')
             self._port_handle = serial.Serial(baudrate=self._baudrate, timeout=1.0)
             self._port_handle.port = self._if_name
             self._port_handle.open()
         return True
 
     def close(self):
-        self._port_handle.port.close()
+        self._port_handle.close()
         self._port_handle = None
         return True
 
@@ -177,10 +179,7 @@ class tcp_interface(comm_interface):
         return True
 
     def write(self, bytes_):
-        try:
-            self._socket.send(bytes_)
-        except socket.error as msg:
-            fail("{} ({:d})".format(str(msg[0]), msg[1]))
+        self._socket.send(bytes_)  # socket.error is handled by the caller
         return True
 
     def read(self):
@@ -188,6 +187,8 @@ class tcp_interface(comm_interface):
         sof = False
         while True:
             b = self._socket.recv(1)
+            if not b:  # connection closed
+                break
             b = ord(b)
             if b == uframe._SOF:
                 bytes_ = bytearray()
@@ -225,10 +226,7 @@ class udp_interface(comm_interface):
         return True
 
     def write(self, bytes_):
-        try:
-            self._socket.sendto(bytes_, (self._if_name, 5005))
-        except socket.error as msg:
-            fail("{} ({:d})".format(str(msg[0]), msg[1]))
+        self._socket.sendto(bytes_, (self._if_name, 5005))  # socket.error is handled by the caller
         return True
 
     def read(self):
@@ -448,6 +446,7 @@ def handle_response(command, frame, args, quiet=False):
         print("Unknown response {:d} from device.".format(resp_command))
 
     if args.json:
+        import json
         print(json.dumps(_json, indent=4, sort_keys=True))
 
     return ret_dict
@@ -466,8 +465,11 @@ def communicate(comms, frame, args, quiet=False):
     if args.verbose:
         print("Communicating with {}".format(comms.name()))
         print("TX {:2d} bytes [{}]".format(len(bytes_), " ".join("{:02x}".format(b) for b in bytes_)))
-    if not comms.write(bytes_):
-        fail("write failed on {}".format(comms.name()))
+    try:
+        if not comms.write(bytes_):
+            fail("write failed on {}".format(comms.name()))
+    except (socket.error, IOError) as e:
+        fail("{} on {}".format(e, comms.name()))
     resp = comms.read()
     if len(resp) == 0:
         fail("timeout talking to device {}".format(comms._if_name))
@@ -484,16 +486,453 @@ def communicate(comms, frame, args, quiet=False):
         return handle_response(frame.get_frame()[1], f, args, quiet)
 
 
+class device_state(object):
+    """
+    The settings of a device as last seen by a dps_session: output state,
+    active function and its parameters (name -> value string). Queries
+    refresh it and successful set commands write through to it. Anything
+    not known is None. The settings are only trusted for ttl_s seconds after
+    a query, the front panel may have changed them since.
+    """
+
+    def __init__(self, ttl_s=2.0):
+        self.ttl_s = ttl_s
+        self.front_panel_changes = 0
+        self.invalidate()
+
+    def invalidate(self):
+        self.output_enabled = None
+        self.func = None
+        self.params = {}
+        self._queried = None  # time.monotonic() of the last query
+
+    def fresh(self):
+        return self._queried is not None and time.monotonic() - self._queried <= self.ttl_s
+
+    def update(self, status):
+        """
+        Take the settings from a query response. If a setting we knew differs,
+        it was changed on the device itself: count it in front_panel_changes
+        and trust nothing until the next query, as it may be changing still.
+        """
+        output_enabled = bool(status['output_enabled'])
+        changed = self.fresh() and (
+            (self.output_enabled is not None and output_enabled != self.output_enabled) or
+            (self.func is not None and status['cur_func'] != self.func) or
+            any(k in self.params and self.params[k] != v for k, v in status['params'].items()))
+        if changed:
+            self.front_panel_changes += 1
+            self.invalidate()
+            return
+        self.output_enabled = output_enabled
+        self.func = status['cur_func']
+        self.params = dict(status['params'])
+        self._queried = time.monotonic()
+
+
+class dps_session(object):
+    """
+    A session keeps the communication interface open across commands and
+    returns decoded responses. Errors raise CommsException instead of exiting
+    so long running tools (the GUI, benchmarks) can carry on.
+
+    Unless use_cache is False, the session keeps a device_state and skips set
+    commands that would not change anything according to it. 'skipped'
+    counts them.
+    """
+
+    _comms = None
+    _is_open = False
+
+    def __init__(self, comms, use_cache=True):
+        self._comms = comms
+        self.state = device_state() if use_cache else None
+        self.skipped = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def name(self):
+        return self._comms.name()
+
+    def open(self):
+        if not self._is_open:
+            if not self._comms.open():
+                raise CommsException("could not open {}".format(self._comms.name()))
+            self._is_open = True
+
+    def close(self):
+        if self._is_open:
+            self._is_open = False
+            self._comms.close()
+
+    def transact(self, frame):
+        """
+        Send frame and return the unescaped, CRC checked response frame
+        """
+        try:
+            return self._transact(frame)
+        except CommsException:
+            # We no longer know what the device did
+            if self.state is not None:
+                self.state.invalidate()
+            raise
+
+    def _transact(self, frame):
+        self.open()
+        bytes_ = frame.get_frame()
+        command = bytes_[1]
+        try:
+            if not self._comms.write(bytes_):
+                raise CommsException("write failed on {}".format(self._comms.name()))
+            resp = self._comms.read()
+        except (socket.error, IOError) as e:
+            # The interface is in an unknown state, start over on the next command
+            self.close()
+            raise CommsException("{} on {}".format(e, self._comms.name()))
+        if len(resp) == 0:
+            raise CommsException("timeout talking to device {}".format(self._comms.name()))
+
+        f = uframe.uFrame()
+        res = f.set_frame(resp)
+        if res < 0:
+            raise CommsException("protocol error ({:d})".format(res))
+        payload = f.get_frame()
+        if len(payload) == 0:
+            raise CommsException("sent command {:02x}, response was empty".format(command))
+        if len(payload) < 2 or payload[0] != protocol.CMD_RESPONSE | command:
+            raise CommsException("sent command {:02x}, response was {:02x}".format(command, payload[0]))
+        if command != protocol.CMD_UPGRADE_START and command != protocol.CMD_UPGRADE_DATA and not payload[1]:
+            raise CommsException("command failed according to device")
+        return f
+
+    def ping(self):
+        self.transact(create_cmd(protocol.CMD_PING))
+
+    def query(self):
+        """
+        Return the decoded query response, see protocol.unpack_query_response
+        """
+        status = unpack_query_response(self.transact(create_cmd(protocol.CMD_QUERY)))
+        if self.state is not None:
+            self.state.update(status)
+        return status
+
+    def cal_report(self):
+        return unpack_cal_report(self.transact(create_cmd(protocol.CMD_CAL_REPORT)))
+
+    def version(self):
+        return unpack_version_response(self.transact(create_cmd(protocol.CMD_VERSION)))
+
+    def _known(self):
+        """
+        Return the device_state if it can be trusted to skip a command
+        """
+        return self.state if self.state is not None and self.state.fresh() else None
+
+    def list_functions(self):
+        """
+        Return the names of the functions the device supports
+        """
+        f = self.transact(create_cmd(protocol.CMD_LIST_FUNCTIONS))
+        f.unpack8()  # command
+        f.unpack8()  # status
+        functions = []
+        while not f.eof():
+            name = f.unpack_cstr()
+            if name == "":
+                break
+            functions.append(name)
+        return functions
+
+    def list_parameters(self):
+        """
+        Return the active function and a list of its parameters, each a
+        dictionary of 'name', 'unit' and 'prefix' (see unit_name() and
+        prefix_name(), kept as numbers here)
+        """
+        f = self.transact(create_cmd(protocol.CMD_LIST_PARAMETERS))
+        f.unpack8()  # command
+        f.unpack8()  # status
+        func = f.unpack_cstr()
+        parameters = []
+        while not f.eof():
+            parameters.append({'name': f.unpack_cstr(), 'unit': f.unpack8(), 'prefix': f.unpacks8()})
+        return func, parameters
+
+    def set_function(self, name):
+        state = self._known()
+        if state and state.func == name and state.output_enabled is False:
+            self.skipped += 1
+            return
+        self.transact(create_set_function(name))
+        if self.state is not None:
+            # The parameters are those of the new function, and the output may have been turned off
+            self.state.func = name
+            self.state.params = {}
+            self.state.output_enabled = None
+
+    def enable_output(self, activate):
+        """
+        activate is 'on' or 'off', as for dpsctl -o. 'off' is always sent,
+        the front panel may have turned the output on since the last query.
+        """
+        state = self._known()
+        if activate == 'on' and state and state.output_enabled:
+            self.skipped += 1
+            return
+        self.transact(create_enable_output(activate))
+        if self.state is not None:
+            self.state.output_enabled = activate == 'on'
+
+    def set_parameters(self, parameter_list):
+        """
+        Set function parameters given as a list of "<name>=<value>" strings.
+        Return a dictionary of parameter name to device status (0 is ok).
+        All parameters are sent in one command. A parameter given more than
+        once is sent with its last value, and parameters already set to the
+        requested value are not sent at all.
+        """
+        requested = {}
+        for p in parameter_list:
+            if "=" not in p:
+                raise ValueError("malformed parameters")
+            name, value = p.split("=", 1)
+            requested[name.strip()] = value.strip()
+        statuses = {}
+        state = self._known()
+        if state:
+            for name, value in list(requested.items()):
+                if state.params.get(name) == value:
+                    statuses[name] = 0
+                    del requested[name]
+                    self.skipped += 1
+            if not requested:
+                return statuses
+        payload = create_set_parameter(["{}={}".format(n, v) for n, v in requested.items()])
+        if not payload:
+            raise ValueError("malformed parameters")
+        f = self.transact(payload)
+        f.unpack8()  # command
+        f.unpack8()  # status
+        for name, value in requested.items():
+            statuses[name] = f.unpack8() if not f.eof() else None
+            if statuses[name] == 0 and self.state is not None:
+                self.state.params[name] = value
+        return statuses
+
+
+# SI prefixes accepted on parameter values (eg. voltage=3.3V or voltage=3300mV)
+VALUE_PREFIXES = {'u': -6, 'm': -3, '': 0, 'k': 3}
+
+
+class function_catalog(object):
+    """
+    An on-disk cache of the functions and function parameters of firmware
+    builds. They never change for a build, so they are keyed by the boot and
+    app git hashes reported by CMD_VERSION and only ever asked for once.
+    The device only lists the parameters of its active function, so those
+    of each function are added as it is seen active. The device is asked
+    for them until every function has been seen.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._builds = {}  # key() -> {'functions': [...], 'parameters': {function: [...]}}
+        self._dirty = False
+
+    @staticmethod
+    def key(version):
+        """
+        Return the catalog key of a dps_session.version() response
+        """
+        return "{}/{}".format(version['boot_git_hash'], version['app_git_hash'])
+
+    def load(self):
+        """
+        Load the cache file, a missing or broken file is an empty catalog
+        """
+        import json
+        self._builds = {}
+        try:
+            with open(self.file_name) as f:
+                builds = json.load(f)
+            if isinstance(builds, dict):
+                self._builds = builds
+        except (IOError, OSError, ValueError):
+            pass
+        return self
+
+    def save(self):
+        """
+        Write the cache file if anything was added, replacing it atomically
+        """
+        import json
+        if not self._dirty:
+            return
+        directory = os.path.dirname(self.file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_name = "{}.{:d}.tmp".format(self.file_name, os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump(self._builds, f, indent=4, sort_keys=True)
+        os.replace(tmp_name, self.file_name)
+        self._dirty = False
+
+    def functions(self, key):
+        return self._builds.get(key, {}).get('functions')
+
+    def parameters(self, key, function=None):
+        """
+        Return the parameters of a function, or a dictionary of parameter
+        name to parameter of all the functions known so far if function
+        is None
+        """
+        known = self._builds.get(key, {}).get('parameters', {})
+        if function is not None:
+            return known.get(function)
+        return dict((p['name'], p) for params in known.values() for p in params)
+
+    def complete(self, key):
+        """
+        Return True if the parameters of every function are known
+        """
+        functions = self.functions(key)
+        return functions is not None and all(self.parameters(key, f) is not None for f in functions)
+
+    def lookup(self, session, names=()):
+        """
+        Return the key of the device behind session and its active function,
+        or None for the function if the catalog did not need to ask for it.
+        The device is asked for its functions if the build is new, and for
+        its active function's parameters only if some of the parameter
+        'names' are not known yet.
+        """
+        key = self.key(session.version())
+        func = None
+        build = self._builds.setdefault(key, {'functions': None, 'parameters': {}})
+        if build['functions'] is None:
+            build['functions'] = session.list_functions()
+            self._dirty = True
+        known = self.parameters(key)
+        if not self.complete(key) and any(name not in known for name in names):
+            func, parameters = session.list_parameters()
+            if build['parameters'].get(func) != parameters:
+                build['parameters'][func] = parameters
+                self._dirty = True
+        return key, func
+
+    def validate(self, key, parameter_list, function=None):
+        """
+        Check "<name>=<value>" parameters against the parameters of the
+        active function, or of any function of the build if it is not
+        given, and return them with the values in the device's units. A
+        value may carry its unit, eg. voltage=3.3V or current=500mA.
+        Raises ValueError for unknown parameters and wrong units.
+        """
+        strict = function is not None or self.complete(key)
+        known = self.parameters(key)
+        if function is not None:
+            known = dict((p['name'], p) for p in self.parameters(key, function) or [])
+        validated = []
+        for p in parameter_list:
+            if "=" not in p:
+                raise ValueError("malformed parameter '{}'".format(p))
+            name, value = [part.strip() for part in p.split("=", 1)]
+            if name not in known:
+                if strict:
+                    raise ValueError("unknown parameter '{}'".format(name))
+                validated.append(p)  # It may belong to a function we have not seen yet
+                continue
+            validated.append("{}={}".format(name, parameter_value(value, known[name])))
+        return validated
+
+
+def parameter_value(value, parameter):
+    """
+    Return value, optionally given with a prefixed unit, as an integer
+    string in the prefixed unit of the parameter (a catalog entry)
+    """
+    unit = unit_name(parameter['unit'])
+    units = "{}{}".format(prefix_name(parameter['prefix']), unit)
+    number = value
+    scale = 1
+    if unit not in ("unitless", "unknown") and value.endswith(unit):
+        number = value[:-len(unit)]
+        prefix = number[-1:] if number[-1:].isalpha() else ''
+        if prefix not in VALUE_PREFIXES:
+            raise ValueError("{} is in {}, not '{}'".format(parameter['name'], units, value))
+        number = number[:len(number) - len(prefix)]
+        scale = 10 ** (VALUE_PREFIXES[prefix] - parameter['prefix'])
+    elif value[-1:].isalpha():
+        raise ValueError("{} is in {}, not '{}'".format(parameter['name'], units, value))
+    try:
+        scaled = float(number) * scale
+    except ValueError:
+        raise ValueError("{} needs a number, not '{}'".format(parameter['name'], value))
+    if abs(scaled - round(scaled)) > 1e-6:
+        raise ValueError("{} is in whole {}, not '{}'".format(parameter['name'], units, value))
+    if scale == 1 and "." not in number:
+        return number  # As given
+    return "{:d}".format(int(round(scaled)))
+
+
+def validate_parameters(comms, parameter_list):
+    """
+    Check parameters against the function catalog of the device behind
+    comms, return them with their values in the device's units. Only fails
+    for parameters that are certainly wrong, the device has the last word.
+    """
+    catalog = function_catalog(catalog_file()).load()
+    session = dps_session(comms, use_cache=False)
+    try:
+        key, function = catalog.lookup(session, [p.split("=", 1)[0].strip() for p in parameter_list])
+    except CommsException:
+        return parameter_list  # The command itself will report the problem
+    finally:
+        session.close()
+        try:
+            catalog.save()
+        except (IOError, OSError) as e:
+            print("Warning: could not save function catalog ({})".format(e))
+    try:
+        return catalog.validate(key, parameter_list, function)
+    except ValueError as e:
+        fail(str(e))
+
+
 def handle_commands(args):
     """
     Communicate with the DPS device according to the user's wishes
     """
     if args.scan:
-        uhej_scan()
+        uhej_scan(args.scan_count if hasattr(args, 'scan_count') else None,
+                  args.scan_timeout if hasattr(args, 'scan_timeout') else 6.0,
+                  not args.no_scan_cache if hasattr(args, 'no_scan_cache') else True,
+                  args.scan_cache_ttl if hasattr(args, 'scan_cache_ttl') else None,
+                  args.scan_iface if hasattr(args, 'scan_iface') else None)
         return
 
     comms = create_comms(args)
 
+    if hasattr(args, 'bench') and args.bench:
+        run_bench(comms, args)
+        return
+
+    if hasattr(args, 'log') and args.log:
+        run_log(comms, args)
+        return
+
+    if hasattr(args, 'watch') and args.watch is not None:
+        if args.watch < 0:
+            fail("--watch rate must not be negative")
+        run_watch(comms, args)
+        return
+
     if args.ping:
         communicate(comms, create_cmd(protocol.CMD_PING), args)
 
@@ -521,6 +960,8 @@ def handle_commands(args):
             fail("enable is 'on' or 'off'")
 
     if args.parameter:
+        if not getattr(args, 'no_catalog', False):
+            args.parameter = validate_parameters(comms, args.parameter)
         payload = create_set_parameter(args.parameter)
         if payload:
             communicate(comms, payload, args)
@@ -611,6 +1052,8 @@ def run_upgrade(comms, fw_file_name, args):
     """
     Run OpenDPS firmware upgrade
     """
+    import codecs
+    crc16 = import_dependency('crc16', 'crc16')
     with open(fw_file_name, mode='rb') as file:
         # crc = binascii.crc32(file.read()) % (1<<32)
         content = file.read()
@@ -713,6 +1156,9 @@ def do_calibration(comms, args):
     """
     Run DPS calibration prompts
     """
+    if calibration_debug_plotting:
+        import matplotlib.pyplot as plt
+
     print("For calibration you will need:")
     print("\tA multimeter")
     print("\tA known load capable of handling the required power")
@@ -1085,47 +1531,13 @@ def do_calibration(comms, args):
     print("To restore the device to the OpenDPS defaults use dpsctl.py --calibration_reset")
 
 
-def uhej_worker_thread():
-    """
-    The worker thread used by uHej for service discovery
-    """
-    from uhej import uhej
-    global discovery_list
-    global sock
-    while 1:
-        try:
-            data, addr = sock.recvfrom(1024)
-            port = addr[1]
-            addr = addr[0]
-            frame = bytearray(data)
-            try:
-                f = uhej.decode_frame(frame)
-                f["source"] = addr
-                f["port"] = port
-                types = ["UDP", "TCP", "mcast"]
-                if uhej.ANNOUNCE == f["frame_type"]:
-                    for s in f["services"]:
-                        key = "{}:{}:{}".format(f["source"], s["port"], s["type"])
-                        if key not in discovery_list:
-                            if s["service_name"] == "opendps":
-                                discovery_list[key] = True  # Keep track of which hosts we have seen
-                                print("{}".format(f["source"]))
-                                # print("{:>16}:{:<5d}  {:<8} {}".format(f["source"], s["port"], types[s["type"]], s["service_name"]))
-            except uhej.IllegalFrameException as e:
-                pass
-        except socket.error as e:
-            print('Exception', e)
-
-
-def uhej_scan():
+def uhej_socket(iface=None):
     """
-    Scan for OpenDPS devices on the local network
+    Create a socket bound to the uHej port and joined to the uHej multicast
+    group, on the given interface (name or IP address) or on the kernel's
+    choice of interface
     """
     from uhej import uhej
-    global discovery_list
-    global sock
-    discovery_list = {}
-
     ANY = "0.0.0.0"
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     try:
@@ -1135,26 +1547,149 @@ def uhej_scan():
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
     sock.bind((ANY, uhej.MCAST_PORT))
+    host = ANY
+    if iface:
+        try:
+            host = uhej.interface_ip(iface)
+        except ValueError as e:
+            sock.close()
+            fail(str(e))
+        sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
+    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(uhej.MCAST_GRP) + socket.inet_aton(host))
+    return sock
+
+
+def catalog_file():
+    """
+    Return the name of the file caching the function catalog
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'dpsctl', 'catalog.json')
+
+
+def discovery_cache_file():
+    """
+    Return the name of the file caching uHej discovery results
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'dpsctl', 'discovery.json')
 
-    thread = threading.Thread(target=uhej_worker_thread)
-    thread.daemon = True
-    thread.start()
 
-    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(uhej.MCAST_GRP) + socket.inet_aton(ANY))
+def uhej_discover(expected_count=None, timeout=6.0, query_interval_s=2.0, service_name="opendps",
+                  cache=None, revalidate=True, revalidate_s=0.5, iface=None, frame_cache=None):
+    """
+    Generator yielding OpenDPS devices on the local network as they announce
+    themselves. Each device is a dictionary with the items
+      "source"       : IP address of the device
+      "port"         : port of the service
+      "type"         : service type (uhej.UDP, uhej.TCP or uhej.MCAST)
+      "service_name" : name of the service
+    Discovery stops once expected_count devices have been seen or after
+    timeout seconds, whichever comes first.
+
+    With a uhcache.DiscoveryCache, the cached hosts are first asked directly
+    (unicast). The multicast sweep only starts if they have not all answered
+    within revalidate_s. Without an expected_count, discovery ends as soon as
+    every cached device has answered. With revalidate False the cache is only
+    updated.
+
+    iface selects the network interface to scan, see uhej_socket().
+
+    Frames already seen from a host are looked up in frame_cache (a
+    uhcache.FrameCache, one is created if not given) instead of being decoded
+    again, devices repeat their announcements a lot. The services of a cached
+    frame are handled like freshly decoded ones, so a frame_cache shared
+    between calls still finds the devices.
+    """
+    from uhej import uhej, uhcache
+    if frame_cache is None:
+        frame_cache = uhcache.FrameCache()
+    sock = uhej_socket(iface)
+    seen = set()
+    query = uhej.query(uhej.UDP, "*")
+    start = time.monotonic()
+    next_query = start
+    pending = set()
+    multicast_sent = False
+    swept = False
+    if cache is not None and revalidate:
+        pending = set((e['ip'], e['port'], e['type']) for e in cache.entries(service_name))
+        for ip in set(p[0] for p in pending):
+            try:
+                sock.sendto(query, (ip, uhej.MCAST_PORT))
+            except OSError:
+                # Stale entry on a network we are not on, leave it to the multicast sweep
+                pending = set(p for p in pending if p[0] != ip)
+        if pending:
+            next_query = start + revalidate_s
+    revalidating = len(pending) > 0
+    try:
+        while expected_count is None or len(seen) < expected_count:
+            if revalidating and not pending and expected_count is None:
+                break  # All cached devices are still there
+            now = time.monotonic()
+            remaining = start + timeout - now
+            if remaining <= 0:
+                swept = multicast_sent
+                break
+            if now >= next_query:
+                sock.sendto(query, (uhej.MCAST_GRP, uhej.MCAST_PORT))
+                multicast_sent = True
+                next_query = now + query_interval_s
+            sock.settimeout(max(0.001, min(remaining, next_query - now)))
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                print('Exception', e)
+                continue
+            services = frame_cache.get(addr[0], data)
+            if services is None:
+                try:
+                    if uhej.ANNOUNCE != uhej.frame_type(data):
+                        services = ()
+                    else:
+                        services = uhej.decode_services(data)
+                except uhej.IllegalFrameException:
+                    services = ()
+                frame_cache.put(addr[0], data, services)
+            for type_, port, name in services:
+                key = (addr[0], port, type_)
+                if name == service_name and key not in seen:
+                    seen.add(key)  # Keep track of which hosts we have seen
+                    pending.discard(key)
+                    if cache is not None:
+                        cache.seen(addr[0], port, type_, name)
+                    yield {"source": addr[0], "port": port, "type": type_, "service_name": name}
+                    if expected_count is not None and len(seen) >= expected_count:
+                        break
+    finally:
+        sock.close()
+        if cache is not None:
+            if swept:
+                # A complete multicast sweep did not find these either, they are gone
+                for ip, port, type_ in pending:
+                    cache.remove(ip, port, type_)
+            try:
+                cache.save()
+            except (IOError, OSError) as e:
+                print("Warning: could not save discovery cache ({})".format(e))
 
-    run_time_s = 6  # Run query for this many seconds
-    query_interval_s = 2  # Send query this often
-    last_query = 0
-    start_time = time.time()
 
-    while time.time() - start_time < run_time_s:
-        if time.time() - last_query > query_interval_s:
-            f = uhej.query(uhej.UDP, "*")
-            sock.sendto(f, (uhej.MCAST_GRP, uhej.MCAST_PORT))
-            last_query = time.time()
-        time.sleep(1)
+def uhej_scan(expected_count=None, timeout=6.0, use_cache=True, cache_ttl_s=None, iface=None):
+    """
+    Scan for OpenDPS devices on the local network, print them as they are found
+    """
+    from uhej import uhcache
+    cache = uhcache.DiscoveryCache(discovery_cache_file(),
+                                   cache_ttl_s if cache_ttl_s is not None else uhcache.default_ttl_s).load()
+    num_found = 0
+    for device in uhej_discover(expected_count, timeout, cache=cache, revalidate=use_cache, iface=iface):
+        num_found += 1
+        print("{}".format(device["source"]))
+        sys.stdout.flush()
 
-    num_found = len(discovery_list)
     if num_found == 0:
         print("No OpenDPS devices found")
     elif num_found == 1:
@@ -1163,6 +1698,245 @@ def uhej_scan():
         print("{:d} OpenDPS devices found".format(num_found))
 
 
+def percentile(sorted_values, pct):
+    """
+    Nearest rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(pct / 100 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def parse_bench_mix(mix):
+    """
+    Parse a mix such as "query=8,parameter=1,cal_report=1" into a list of
+    (operation, weight)
+    """
+    ops = []
+    for item in mix.split(","):
+        parts = item.split("=")
+        name = parts[0].strip()
+        if name not in ('query', 'parameter', 'cal_report'):
+            fail("unknown benchmark operation '{}' (use query, parameter or cal_report)".format(name))
+        try:
+            weight = int(parts[1]) if len(parts) > 1 else 1
+        except ValueError:
+            fail("malformed benchmark mix '{}'".format(mix))
+        if weight > 0:
+            ops.append((name, weight))
+    if not ops:
+        fail("empty benchmark mix")
+    return ops
+
+
+def run_bench(comms, args):
+    """
+    Run a mix of commands over one session for a number of iterations or
+    seconds and report throughput, latency and CPU cost
+    """
+    mix = parse_bench_mix(args.bench_mix)
+    # Interleave the operations according to their weights (query=2,cal_report=1 -> q c q)
+    schedule = []
+    for i in range(max(w for _, w in mix)):
+        schedule.extend(name for name, w in mix if i < w)
+    iterations = args.bench_iterations
+    duration_s = args.bench_duration if args.bench_duration else (None if iterations else 10.0)
+
+    # Every command has to go to the device, the cache would skip the parameter writes
+    session = dps_session(comms, use_cache=False)
+    try:
+        session.open()
+        parameter = args.bench_parameter
+        if parameter is None and any(name == 'parameter' for name, _ in mix):
+            # Write back the current value of the first parameter, this leaves the device as it was
+            params = session.query()['params']
+            if not params:
+                fail("active function has no parameters, use --bench-parameter")
+            key = sorted(params)[0] if 'voltage' not in params else 'voltage'
+            parameter = "{}={}".format(key, params[key])
+    except CommsException as e:
+        fail(str(e))
+
+    ops = {
+        'query': session.query,
+        'parameter': lambda: session.set_parameters([parameter]),
+        'cal_report': session.cal_report,
+    }
+    stats = dict((name, {'latencies': [], 'errors': 0}) for name, _ in mix)
+    if not args.json:
+        print("Benchmarking {} with {} for {}".format(
+              comms.name(), ", ".join("{}={:d}".format(n, w) for n, w in mix),
+              "{:d} iterations".format(iterations) if iterations else "{:.1f} s".format(duration_s)))
+
+    count = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    deadline = start + duration_s if duration_s else None
+    try:
+        while True:
+            if iterations and count >= iterations:
+                break
+            if deadline and time.perf_counter() >= deadline:
+                break
+            name = schedule[count % len(schedule)]
+            t0 = time.perf_counter()
+            try:
+                ops[name]()
+                stats[name]['latencies'].append(time.perf_counter() - t0)
+            except CommsException as e:
+                stats[name]['errors'] += 1
+                if args.verbose:
+                    print("{} failed: {}".format(name, e))
+            count += 1
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    session.close()
+
+    def summary(latencies, errors, ops_count):
+        latencies = sorted(latencies)
+        return {
+            'ops': ops_count,
+            'errors': errors,
+            'ops_per_s': (ops_count - errors) / elapsed if elapsed > 0 else 0.0,
+            'latency_ms': {
+                'min': latencies[0] * 1000 if latencies else 0.0,
+                'p50': percentile(latencies, 50) * 1000,
+                'p90': percentile(latencies, 90) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'max': latencies[-1] * 1000 if latencies else 0.0,
+            },
+        }
+
+    report = {
+        'device': comms.name(),
+        'elapsed_s': elapsed,
+        'cpu_s': cpu,
+        'cpu_us_per_op': cpu / count * 1e6 if count else 0.0,
+        'total': summary([l for s in stats.values() for l in s['latencies']],
+                         sum(s['errors'] for s in stats.values()), count),
+        'operations': dict((name, summary(s['latencies'], s['errors'], len(s['latencies']) + s['errors']))
+                           for name, s in stats.items()),
+    }
+
+    if args.json:
+        import json
+        print(json.dumps(report, indent=4, sort_keys=True))
+        return report
+
+    print("{:<12} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+          'op', 'count', 'errors', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    rows = [(name, report['operations'][name]) for name, _ in mix] + [('total', report['total'])]
+    for name, s in rows:
+        print("{:<12} {:>8d} {:>7d} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+              name, s['ops'], s['errors'], s['ops_per_s'], s['latency_ms']['p50'],
+              s['latency_ms']['p90'], s['latency_ms']['p99'], s['latency_ms']['max']))
+    print("{:d} ops in {:.2f} s, {:.1f} us CPU per op".format(count, elapsed, report['cpu_us_per_op']))
+    return report
+
+
+def next_deadline(deadline, interval_s):
+    """
+    Return the monotonic deadline following 'deadline'. It is scheduled from
+    the previous one so the rate does not drift, and deadlines that have
+    already passed are skipped rather than caught up with.
+    """
+    deadline += interval_s
+    now = time.monotonic()
+    if deadline < now:
+        deadline += math.ceil((now - deadline) / interval_s) * interval_s
+    return deadline
+
+
+# --watch writes its output at least this often (s)
+WATCH_FLUSH_S = 0.5
+
+
+def run_watch(comms, args):
+    """
+    Query the device at args.watch Hz (0 for as fast as it answers) until
+    interrupted, writing one compact JSON object per sample to stdout. The
+    output is flushed every WATCH_FLUSH_S, or before waiting longer than
+    that for the next sample.
+    """
+    import json
+    interval_s = 1.0 / args.watch if args.watch > 0 else 0
+    session = dps_session(comms)
+    out = sys.stdout
+    dumps = json.JSONEncoder(separators=(',', ':')).encode
+    deadline = time.monotonic()
+    flushed = deadline
+    try:
+        while True:
+            sample = {'t': round(time.time(), 6), 'mono': round(time.monotonic(), 6)}
+            try:
+                status = session.query()
+                del status['command']
+                del status['status']
+                sample.update(status)
+            except CommsException as e:
+                sample['error'] = str(e)
+            out.write(dumps(sample))
+            out.write("\n")
+            if interval_s:
+                deadline = next_deadline(deadline, interval_s)
+            now = time.monotonic()
+            if now - flushed >= WATCH_FLUSH_S or deadline - now >= WATCH_FLUSH_S:
+                out.flush()
+                flushed = now
+            if deadline > now:
+                time.sleep(deadline - now)
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # The reader went away (eg. | head). Send whatever is still buffered
+        # to /dev/null so flushing stdout does not fail again on the way out.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+    finally:
+        session.close()
+    out.flush()
+
+
+def run_log(comms, args):
+    """
+    Query the device at args.log_hz and write the samples to args.log until
+    interrupted. The file is written by a background thread so a slow disk
+    does not delay the polling.
+    """
+    import samplelog
+    if args.log_hz <= 0:
+        fail("--log-hz must be positive")
+    interval_s = 1.0 / args.log_hz
+    try:
+        logger = samplelog.sample_logger(args.log, max_bytes=int(args.log_max_mb * 1024 * 1024),
+                                         backups=args.log_backups)
+    except (ValueError, IOError, OSError) as e:
+        fail(str(e))
+    session = dps_session(comms)
+    errors = 0
+    print("Logging {} to {} at {:g} Hz, ^C to stop".format(comms.name(), args.log, args.log_hz))
+    deadline = time.monotonic()
+    try:
+        while True:
+            try:
+                status = session.query()
+                logger.log(status)
+            except CommsException as e:
+                errors += 1
+                if args.verbose:
+                    print("query failed: {}".format(e))
+            deadline = next_deadline(deadline, interval_s)
+            time.sleep(max(0, deadline - time.monotonic()))
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        session.close()
+        logger.close()
+    print("{:d} samples written, {:d} dropped, {:d} query errors".format(logger.written, logger.dropped, errors))
+
+
 def main():
     """
     Ye olde main
@@ -1175,9 +1949,15 @@ def main():
     parser.add_argument('-b', '--baudrate', type=int, dest="baudrate", help="Set baudrate used for serial communications", default=9600)
     parser.add_argument('-B', '--brightness', type=int, help="Set display brightness (0..100)")
     parser.add_argument('-S', '--scan', action="store_true", help="Scan for OpenDPS wifi devices")
+    parser.add_argument('--scan-count', type=int, help="Stop scanning as soon as this many devices have been found")
+    parser.add_argument('--scan-timeout', type=float, default=6.0, help="Scan for at most this many seconds (default 6)")
+    parser.add_argument('--no-scan-cache', action='store_true', help="Do a full multicast scan instead of asking the cached devices first")
+    parser.add_argument('--scan-cache-ttl', type=float, help="Forget cached devices not seen for this many seconds (default one day)")
+    parser.add_argument('--scan-iface', help="Scan on this network interface, given by name (eg. eth0) or IP address")
     parser.add_argument('-f', '--function', nargs='?', help="Set active function")
     parser.add_argument('-F', '--list-functions', action='store_true', help="List available functions")
     parser.add_argument('-p', '--parameter', nargs='+', help="Set function parameter <name>=<value>")
+    parser.add_argument('--no-catalog', action='store_true', help="Send -p parameters as given, without checking them against the cached function catalog")
     parser.add_argument('-P', '--list-parameters', action='store_true', help="List function parameters of active function")
     parser.add_argument('-C', '--calibrate', action="store_true", help="Starts System Calibration Routine")
     parser.add_argument('-c', '--calibration_set', nargs='+', help="Set the specified calibration coefficient <name>=<value>")
@@ -1189,11 +1969,21 @@ def main():
     parser.add_argument('-l', '--unlock', action='store_true', help="Unlock device keys")
     parser.add_argument('-q', '--query', action='store_true', help="Query device settings and measurements")
     parser.add_argument('-j', '--json', action='store_true', help="Output parameters as JSON")
+    parser.add_argument('--watch', type=float, nargs='?', const=1.0, metavar='HZ', help="Query the device HZ times per second (default 1, 0 for as fast as it answers) until interrupted, printing one JSON object per line")
     parser.add_argument('-v', '--verbose', action='store_true', help="Verbose communications")
     parser.add_argument('-V', '--version', action='store_true', help="Get firmware version information")
     parser.add_argument('-U', '--upgrade', type=str, dest="firmware", help="Perform upgrade of OpenDPS firmware")
     parser.add_argument('--screen', type=str, dest="switch_screen", help="Switch to 'settings' or 'main' screen")
     parser.add_argument('--force', action='store_true', help="Force upgrade even if dpsctl complains about the firmware")
+    parser.add_argument('--bench', action='store_true', help="Benchmark the link to the device with a mix of commands")
+    parser.add_argument('--bench-mix', default="query=8,parameter=1,cal_report=1", help="Benchmark command mix as <op>=<weight>,... with op being query, parameter or cal_report (default query=8,parameter=1,cal_report=1)")
+    parser.add_argument('--bench-iterations', type=int, help="Run the benchmark for this many commands")
+    parser.add_argument('--bench-duration', type=float, help="Run the benchmark for this many seconds (default 10 unless --bench-iterations is given)")
+    parser.add_argument('--log', metavar='FILE', help="Log queries to FILE until interrupted, as CSV or as binary records if FILE ends with .bin")
+    parser.add_argument('--log-hz', type=float, default=1.0, help="Sample rate for --log (default 1)")
+    parser.add_argument('--log-max-mb', type=float, default=0, help="Rotate the log file when it grows past this many MB (default never)")
+    parser.add_argument('--log-backups', type=int, default=5, help="Number of rotated log files kept (default 5)")
+    parser.add_argument('--bench-parameter', help="Parameter <name>=<value> written by the benchmark (default: rewrite the current voltage setting)")
     if testing:
         parser.add_argument('-t', '--temperature', type=str, dest="temperature", help="Send temperature report (for testing)")
 
@@ -0,0 +1,263 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2024 Gabriel Tremblay (github.com/gtremblay)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Helpers creating the response frames an OpenDPS device sends back. They
+mirror what the unpack_* functions in protocol.py and handle_response in
+dpsctl.py expect.
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+
+# A binary log starts with MAGIC followed by fixed size records of
+#   monotonic      : double   host time.monotonic() when the sample was taken
+#   wall           : double   host time.time() when the sample was taken
+#   v_in           : uint16   input voltage in mV
+#   v_out          : uint16   output voltage in mV
+#   i_out          : uint16   output current in mA
+#   temp1          : int16    temperature in 0.1 degrees, NO_TEMPERATURE if not reported
+#   temp2          : int16    as temp1
+#   output_enabled : uint8
+#   function       : uint8    index into FUNCTIONS, NO_FUNCTION if not listed
+# all little endian. A record cut short by a crash is ignored when reading,
+# and cut off before anything is appended to the file.
+MAGIC = b"DPSlog1\n"
+RECORD = struct.Struct("<ddHHHhhBB")
+FUNCTIONS = ['cv', 'cc', 'cl', 'funcgen']
+NO_FUNCTION = 0xff
+NO_TEMPERATURE = -0x8000
+
+CSV_HEADER = "monotonic_s,wall_s,v_in_mv,v_out_mv,i_out_ma,temp1_c,temp2_c,output_enabled,function\n"
+
+# Samples queued for the writer thread, further samples are dropped
+QUEUE_SIZE = 4096
+# The writer thread writes at most this many samples at once
+BATCH_SIZE = 256
+# and flushes the file at least this often (s)
+FLUSH_INTERVAL_S = 1.0
+
+
+def _temperature(status, key):
+    value = status.get(key)
+    return NO_TEMPERATURE if value is None else int(round(value * 10))
+
+
+def encode_binary(samples):
+    """
+    Return the binary records of a list of (monotonic, wall, status)
+    """
+    out = bytearray()
+    for mono, wall, status in samples:
+        func = status['cur_func']
+        out += RECORD.pack(mono, wall, status['v_in'], status['v_out'], status['i_out'],
+                           _temperature(status, 'temp1'), _temperature(status, 'temp2'),
+                           1 if status['output_enabled'] else 0,
+                           FUNCTIONS.index(func) if func in FUNCTIONS else NO_FUNCTION)
+    return bytes(out)
+
+
+def encode_csv(samples):
+    """
+    Return the CSV lines of a list of (monotonic, wall, status)
+    """
+    lines = []
+    for mono, wall, status in samples:
+        lines.append("{:.6f},{:.6f},{:d},{:d},{:d},{},{},{:d},{}\n".format(
+            mono, wall, status['v_in'], status['v_out'], status['i_out'],
+            status.get('temp1', ""), status.get('temp2', ""),
+            1 if status['output_enabled'] else 0, status['cur_func']))
+    return "".join(lines).encode()
+
+
+def read_binary(file_name):
+    """
+    Yield (monotonic, wall, v_in, v_out, i_out, temp1, temp2, output_enabled,
+    function) for each record of a binary log. Missing temperatures are None
+    and the function is its name, or None if unknown. Raises ValueError if
+    the file is not a binary log.
+    """
+    with open(file_name, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a dpsctl binary log".format(file_name))
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            mono, wall, v_in, v_out, i_out, temp1, temp2, enabled, func = RECORD.unpack(record)
+            yield (mono, wall, v_in, v_out, i_out,
+                   None if temp1 == NO_TEMPERATURE else temp1 / 10,
+                   None if temp2 == NO_TEMPERATURE else temp2 / 10,
+                   bool(enabled), FUNCTIONS[func] if func < len(FUNCTIONS) else None)
+
+
+def prepare_file(file_name, binary):
+    """
+    Make an existing log ready for appending: cut off a record or line left
+    incomplete by a crash, so new samples start where a whole one ended.
+    Raises ValueError if the file is not a log of the given format.
+    """
+    try:
+        size = os.path.getsize(file_name)
+    except OSError:
+        return  # New file
+    with open(file_name, "r+b") as f:
+        header = MAGIC if binary else CSV_HEADER.encode()
+        start = f.read(len(header))
+        if size < len(header) and header.startswith(start):
+            f.truncate(0)  # Crashed while writing the header
+            return
+        if start != header:
+            raise ValueError("{} is not a dpsctl {} log".format(file_name, "binary" if binary else "CSV"))
+        if binary:
+            end = size - (size - len(MAGIC)) % RECORD.size
+        else:
+            # Keep everything up to the last newline
+            end = size
+            while end > len(header):
+                f.seek(max(len(header), end - 1024))
+                chunk = f.read(end - f.tell())
+                if chunk.endswith(b"\n"):
+                    break
+                if b"\n" in chunk:
+                    end -= len(chunk) - chunk.rindex(b"\n") - 1
+                    break
+                end -= len(chunk)
+        if end != size:
+            f.truncate(end)
+
+
+class sample_logger(object):
+    """
+    Writes query samples to a CSV or binary file from a background thread.
+    log() only queues the sample so the poll loop never waits for the disk.
+    If the queue is full the sample is dropped and counted in 'dropped'.
+
+    With max_bytes set, the file is rotated before it grows past that size:
+    file_name becomes file_name.1, file_name.1 becomes file_name.2 and so on
+    up to 'backups' files.
+
+    An existing file is appended to, see prepare_file(). Raises ValueError
+    if it is not a log of the same format.
+    """
+
+    def __init__(self, file_name, binary=None, max_bytes=0, backups=5):
+        self.file_name = file_name
+        self.binary = file_name.endswith(".bin") if binary is None else binary
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._f = None
+        prepare_file(file_name, self.binary)
+        self._open()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, status, mono=None, wall=None):
+        """
+        Queue a status returned by dps_session.query(), timestamped now
+        unless given
+        """
+        if self.error is not None:
+            self.dropped += 1
+            return
+        sample = (time.monotonic() if mono is None else mono, time.time() if wall is None else wall, status)
+        try:
+            self._queue.put_nowait(sample)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Write the queued samples and close the file
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self):
+        self._f = open(self.file_name, "ab")
+        if self._f.tell() == 0:
+            self._f.write(MAGIC if self.binary else CSV_HEADER.encode())
+
+    def _rotate(self):
+        self._f.close()
+        for i in range(self.backups - 1, 0, -1):
+            name = "{}.{:d}".format(self.file_name, i)
+            if os.path.exists(name):
+                os.replace(name, "{}.{:d}".format(self.file_name, i + 1))
+        if self.backups > 0:
+            os.replace(self.file_name, self.file_name + ".1")
+        else:
+            os.remove(self.file_name)
+        self._open()
+
+    def _write(self, samples):
+        data = encode_binary(samples) if self.binary else encode_csv(samples)
+        if self.max_bytes and self._f.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self._f.write(data)
+        self.written += len(samples)
+
+    def _run(self):
+        flush_at = time.monotonic() + FLUSH_INTERVAL_S
+        done = False
+        while not done:
+            samples = []
+            try:
+                sample = self._queue.get(timeout=max(0, flush_at - time.monotonic()))
+                while sample is not None:
+                    samples.append(sample)
+                    if len(samples) >= BATCH_SIZE:
+                        break
+                    sample = self._queue.get_nowait()
+                done = sample is None
+            except queue.Empty:
+                pass
+            try:
+                if samples:
+                    self._write(samples)
+                if done or time.monotonic() >= flush_at:
+                    self._f.flush()
+                    flush_at = time.monotonic() + FLUSH_INTERVAL_S
+            except (IOError, OSError) as e:
+                # Give up, further samples are counted as dropped
+                self.error = e
+                print("Sample log {} failed: {}".format(self.file_name, e))
+                self._f.close()
+                self._f = None
+                return
@@ -40,10 +40,7 @@ logger.info("Client starting")
 #time.tzset()
 
 node_id = 32768
-try:
-    ip = socket.gethostbyname(socket.gethostname())
-except:
-    ip = socket.gethostbyname(socket.gethostname()+".local")
+ip = uhej_client.get_local_ip()
 
 
 mac = "aa:bb:cc:dd:ee:ff"
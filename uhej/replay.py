@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+ The MIT License (MIT)
+
+ Copyright (c) 2017 Johan Kanflo (github.com/kanflo)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+
+#
+# Replay a uHej capture written by 'sniffer.py -w', either into the frame
+# decoders or onto the multicast group
+#
+
+import argparse
+import socket
+import sys
+import time
+from uhej import *
+from uhcapture import read_capture
+
+
+# Return the replay time of each record relative to the first. Records are
+# paced by the time between them, at most 'max_gap' seconds, as a capture
+# appended to by several runs has timestamps from unrelated clocks.
+def replay_offsets(records, max_gap):
+    offsets = [0.0]
+    for prev, cur in zip(records, records[1:]):
+        offsets.append(offsets[-1] + min(max(cur[0] - prev[0], 0.0), max_gap))
+    return offsets
+
+# Wait until 'offset' into the capture is due, the replay having started at
+# 'start', 'speed' times faster than real time
+def wait_for(offset, start, speed):
+    delay = start + offset / speed - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+# argparse type for the options that must be greater than zero
+def positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % value)
+    return number
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a uHej capture file')
+    parser.add_argument('capture', help="Capture file written by 'sniffer.py -w'")
+    parser.add_argument('-m', '--mcast', action='store_true', help="Send the frames to %s:%d instead of decoding them" % (MCAST_GRP, MCAST_PORT))
+    parser.add_argument('-s', '--speed', type=positive_float, default=1.0, help="Replay this many times faster than captured (default 1)")
+    parser.add_argument('-f', '--fast', action='store_true', help="Replay as fast as possible")
+    parser.add_argument('-g', '--max-gap', type=float, default=1.0, help="Wait at most this many seconds between two frames (default 1)")
+    parser.add_argument('-n', '--repeat', type=int, default=1, help="Replay the capture this many times")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print each decoded frame")
+    args = parser.parse_args()
+
+    try:
+        records = list(read_capture(args.capture))
+    except (IOError, OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    if not records:
+        print("%s holds no frames" % args.capture)
+        sys.exit(0)
+
+    sock = None
+    if args.mcast:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+
+    count = illegal = 0
+    offsets = replay_offsets(records, args.max_gap)
+    start = time.monotonic()
+    for i in range(args.repeat):
+        for offset, (timestamp, addr, frame) in zip(offsets, records):
+            if not args.fast:
+                wait_for(offset + i * offsets[-1], start, args.speed)
+            if sock:
+                sock.sendto(frame, (MCAST_GRP, MCAST_PORT))
+            else:
+                try:
+                    f = decode_frame(frame)
+                    if args.verbose:
+                        print("%s:%d %s" % (addr[0], addr[1], f))
+                except IllegalFrameException:
+                    illegal += 1
+            count += 1
+    elapsed = time.monotonic() - start
+
+    print("%d frames replayed in %.3f s (%.0f frames/s), %d illegal" % (count, elapsed, count / elapsed if elapsed else 0, illegal))
+
+if __name__ == '__main__':
+    main()
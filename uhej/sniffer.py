@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
+import argparse
 import socket
 import binascii
+import time
 from uhej import *
+from uhcapture import CaptureWriter
+from uhstats import TrafficStats
 import logging
 
 logger = logging.getLogger()
@@ -15,8 +19,39 @@ def log_init(level):
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+# Log a received frame
+def print_frame(data, addr, port):
+    try:
+        f = decode_frame(data)
+        f["source"] = addr
+        f["port"] = port
+        services = ["UDP", "TCP", "Multicast"]
+        if ANNOUNCE == f["frame_type"]:
+            logger.info("Announce frame")
+            print(f)
+        elif HELLO == f["frame_type"]:
+            logger.info("Hello frame")
+            print(f)
+        elif QUERY == f["frame_type"]:
+            logger.info("Query %s service '%s' from %s", services[f["service_type"]], f["service_name"], f["source"])
+    except IllegalFrameException as e:
+        print("%s:%d Illegal frame '%s'" % (addr, port, binascii.hexlify(data)))
+
 def main():
+    parser = argparse.ArgumentParser(description='Sniff uHej frames on %s:%d' % (MCAST_GRP, MCAST_PORT))
+    parser.add_argument('-w', '--write', metavar='FILE', help="Append the received frames to a capture file, see replay.py")
+    parser.add_argument('-i', '--iface', help="Listen on this network interface (name or IP address)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Do not print the received frames")
+    parser.add_argument('-s', '--stats', type=float, nargs='?', const=10.0, metavar='SECONDS', help="Print a table of the top talkers this often (default 10 s) instead of the frames")
+    parser.add_argument('-t', '--top', type=int, default=10, help="Number of sources in the top talkers table (default 10)")
+    args = parser.parse_args()
+
     log_init(logging.INFO);
+    try:
+        capture = CaptureWriter(args.write) if args.write else None
+    except (IOError, OSError, ValueError) as e:
+        parser.error(str(e))
+    stats = TrafficStats() if args.stats else None
 
     ANY = "0.0.0.0"
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -29,43 +64,49 @@ def main():
 
     sock.bind((ANY, MCAST_PORT))
 #    sock.bind((MCAST_GRP, MCAST_PORT))
-    if 0:
+    host = ANY
+    if args.iface:
         try:
-            host = socket.gethostbyname(socket.gethostname()+".local")
-        except:
-            host = socket.gethostbyname(socket.gethostname())
+            host = interface_ip(args.iface)
+        except ValueError as e:
+            sock.close()
+            parser.error(str(e))
         logger.info("Sniffer starting on %s" % host)
-
         sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
-    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(ANY))
+    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(host))
 
-    while 1:
-        try:
-            data, addr = sock.recvfrom(1024)
-            port = addr[1]
-            addr = addr[0]
-            frame = bytearray(data)
+    next_report = time.monotonic() + args.stats if stats is not None else None
+    try:
+        while 1:
+            if stats is not None:
+                now = time.monotonic()
+                if now >= next_report:
+                    print(stats.report(args.top, now))
+                    print("")
+                    next_report += args.stats
+                sock.settimeout(max(0.001, next_report - now))
             try:
-                f = decode_frame(frame)
-                f["source"] = addr
-                f["port"] = port
-                hexdata = binascii.hexlify(data)
-                services = ["UDP", "TCP", "Multicast"]
-                if ANNOUNCE == f["frame_type"]:
-                    logger.info("Announce frame")
-                    print(f)
-                elif HELLO == f["frame_type"]:
-                    logger.info("Hello frame")
-                    print(f)
-                elif QUERY == f["frame_type"]:
-                    logger.info("Query %s service '%s' from %s", services[f["service_type"]], f["service_name"], f["source"])
-            except IllegalFrameException as e:
-                print("%s:%d Illegal frame '%s'" % (addr, port, frame))
-
-        except socket.error as e:
-            print('Exception')
-            hexdata = binascii.hexlify(data)
-            print('Data = %s' % hexdata)
+                data, addr = sock.recvfrom(1024)
+                if capture:
+                    capture.write(time.monotonic(), addr, data)
+                if stats is not None:
+                    try:
+                        f = frame_type(data)
+                    except IllegalFrameException:
+                        f = None
+                    stats.add(addr[0], f, len(data))
+                elif not args.quiet:
+                    print_frame(data, addr[0], addr[1])
+            except socket.timeout:
+                pass
+            except socket.error as e:
+                print('Exception', e)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if capture:
+            capture.close()
+            print("%d frames written to %s" % (capture.count, args.write))
 
 if __name__ == '__main__':
     main()
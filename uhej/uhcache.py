@@ -0,0 +1,151 @@
+"""
+ The MIT License (MIT)
+
+ Copyright (c) 2017 Johan Kanflo (github.com/kanflo)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+
+import collections
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+default_ttl_s = 24 * 60 * 60
+
+
+# An on-disk cache of discovered services so that the next discovery can ask
+# the known hosts directly instead of starting with a multicast query.
+# Each entry is a dictionary of
+# 'ip'           : string   IP address of the host announcing the service
+# 'port'         : int16    port where service resides
+# 'type'         : int8     type of service (UDP, TCP or MCAST)
+# 'service_name' : string   name of service
+# 'last_seen'    : float    Unix timestamp of the last announce
+class DiscoveryCache(object):
+
+    def __init__(self, file_name, ttl_s=default_ttl_s):
+        self.file_name = file_name
+        self.ttl_s = ttl_s
+        self._entries = {}
+        self._dirty = False
+
+    @staticmethod
+    def _key(ip, port, type):
+        return "%s:%d:%d" % (ip, port, type)
+
+    # Load the cache file, a missing or broken file is an empty cache
+    def load(self):
+        self._entries = {}
+        try:
+            with open(self.file_name) as f:
+                entries = json.load(f)
+            for e in entries:
+                self._entries[self._key(e['ip'], e['port'], e['type'])] = e
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            if os.path.exists(self.file_name):
+                logger.warning("Ignoring discovery cache %s (%s)" % (self.file_name, e))
+        self.evict()
+        return self
+
+    # Write the cache file if anything changed. The file is replaced
+    # atomically so concurrent runs never see a half written cache.
+    def save(self):
+        if not self._dirty:
+            return
+        directory = os.path.dirname(self.file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_name = "%s.%d.tmp" % (self.file_name, os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump(sorted(self._entries.values(), key=lambda e: (e['ip'], e['port'])), f, indent=4, sort_keys=True)
+        os.replace(tmp_name, self.file_name)
+        self._dirty = False
+
+    # Drop entries not seen within the TTL
+    def evict(self, now=None):
+        now = time.time() if now is None else now
+        for key in [k for k, e in self._entries.items() if now - e['last_seen'] > self.ttl_s]:
+            logger.info("Evicting %s from discovery cache" % key)
+            del self._entries[key]
+            self._dirty = True
+
+    # Record that a service was seen now
+    def seen(self, ip, port, type, service_name, now=None):
+        self._entries[self._key(ip, port, type)] = {
+            'ip': ip,
+            'port': port,
+            'type': type,
+            'service_name': service_name,
+            'last_seen': time.time() if now is None else now,
+        }
+        self._dirty = True
+
+    def remove(self, ip, port, type):
+        if self._entries.pop(self._key(ip, port, type), None) is not None:
+            self._dirty = True
+
+    # Return the cached entries, optionally only those of a given service name
+    def entries(self, service_name=None):
+        return [e for e in self._entries.values() if service_name is None or e['service_name'] == service_name]
+
+    # Return the set of IP addresses hosting a given service name
+    def hosts(self, service_name=None):
+        return set(e['ip'] for e in self.entries(service_name))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# A small LRU cache of decoded frames keyed by (source, raw frame bytes).
+# Devices repeat identical announce frames, looking them up here lets
+# discovery skip decoding the copies it has already seen.
+class FrameCache(object):
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._frames = collections.OrderedDict()  # (source, frame) -> decoded frame
+        self.hits = 0
+        self.misses = 0
+
+    # Return the decoded frame cached for 'frame' from 'source', or None
+    def get(self, source, frame):
+        key = (source, bytes(frame))
+        decoded = self._frames.get(key)
+        if decoded is None:
+            self.misses += 1
+            return None
+        self._frames.move_to_end(key)
+        self.hits += 1
+        return decoded
+
+    # Cache the decoded frame, evicting the least recently used one if full.
+    # 'decoded' must not be None.
+    def put(self, source, frame, decoded):
+        key = (source, bytes(frame))
+        self._frames[key] = decoded
+        self._frames.move_to_end(key)
+        if len(self._frames) > self.max_size:
+            self._frames.popitem(last=False)
+
+    def __len__(self):
+        return len(self._frames)
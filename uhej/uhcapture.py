@@ -0,0 +1,112 @@
+"""
+ The MIT License (MIT)
+
+ Copyright (c) 2017 Johan Kanflo (github.com/kanflo)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+
+import os
+import socket
+import struct
+
+# A capture file starts with MAGIC followed by records of
+#   length    : uint16   length of the frame
+#   timestamp : double   time.monotonic() when the frame was received
+#   ip        : uint32   source IP address
+#   port      : uint16   source port
+#   frame     : bytes    the raw frame as received
+# all in network byte order. Files are only ever appended to, a record cut
+# short by a crash is ignored when reading and cut off before appending.
+MAGIC = b"uHejcap1"
+
+_RECORD = struct.Struct("!HdIH")
+
+
+# Return the length of the whole records at the start of capture file 'f',
+# including MAGIC. Raises ValueError if 'f' is not a capture file.
+def _whole_length(f, file_name):
+    size = os.fstat(f.fileno()).st_size
+    start = f.read(len(MAGIC))
+    if size < len(MAGIC) and MAGIC.startswith(start):
+        return 0  # Crashed while writing MAGIC
+    if start != MAGIC:
+        raise ValueError("%s is not a uHej capture file" % file_name)
+    end = len(MAGIC)
+    while end + _RECORD.size <= size:
+        f.seek(end)
+        length = _RECORD.unpack(f.read(_RECORD.size))[0]
+        if end + _RECORD.size + length > size:
+            break
+        end += _RECORD.size + length
+    return end
+
+
+# Appends received frames to a capture file. An existing capture has a record
+# cut short by a crash removed first, raises ValueError if 'file_name' is not
+# a capture file.
+class CaptureWriter(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        if os.path.exists(file_name):
+            with open(file_name, "r+b") as f:
+                end = _whole_length(f, file_name)
+                if end != os.fstat(f.fileno()).st_size:
+                    f.truncate(end)
+        self._f = open(file_name, "ab")
+        if self._f.tell() == 0:
+            self._f.write(MAGIC)
+        self.count = 0
+
+    # Append 'frame' received from 'addr' (ip, port) at monotonic time 'timestamp'
+    def write(self, timestamp, addr, frame):
+        ip = struct.unpack("!I", socket.inet_aton(addr[0]))[0]
+        self._f.write(_RECORD.pack(len(frame), timestamp, ip, addr[1]))
+        self._f.write(frame)
+        self.count += 1
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Yield (timestamp, (ip, port), frame) for each record in a capture file.
+# Raises ValueError if the file is not a capture file.
+def read_capture(file_name):
+    with open(file_name, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a uHej capture file" % file_name)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            length, timestamp, ip, port = _RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp, (socket.inet_ntoa(struct.pack("!I", ip)), port), frame
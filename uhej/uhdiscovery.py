@@ -3,42 +3,53 @@
 # Query local network for uHej services
 #
 
+import argparse
 import socket
 import threading
 import sys
+import time
 from uhej import *
+from uhcache import FrameCache
 
 
 def worker_thread():
     global discovery_list
+    global frame_cache
     global sock
+    types = ["UDP", "TCP", "mcast"]
     while 1:
         try:
             data, addr = sock.recvfrom(1024)
-            port = addr[1]
             addr = addr[0]
-            frame = bytearray(data)
+            if frame_cache.get(addr, data) is not None:
+                continue # Already seen this frame from this host
             try:
-                f = decode_frame(frame)
-                f["source"] = addr
-                f["port"] = port
-                types = ["UDP", "TCP", "mcast"]
-                if ANNOUNCE == f["frame_type"]:
-                    for s in f["services"]:
-                        key = "%s:%s:%s" % (f["source"], s["port"], s["type"])
-                        if not key in discovery_list:
-                            print("%16s:%-5d  %-8s %s" % (f["source"], s["port"], types[s["type"]], s["service_name"]))
-                            discovery_list[key] = True # Keep track of which hosts we have seen
-            except IllegalFrameException, e:
-                pass
-        except socket.error, e:
-            print 'Expection', e
+                if ANNOUNCE == frame_type(data):
+                    services = decode_services(data)
+                else:
+                    services = ()
+            except IllegalFrameException as e:
+                services = ()
+            frame_cache.put(addr, data, services)
+            for type, port, name in services:
+                key = (addr, port, type)
+                if not key in discovery_list:
+                    print("%16s:%-5d  %-8s %s" % (addr, port, types[type], name))
+                    discovery_list.add(key) # Keep track of which hosts we have seen
+        except socket.error as e:
+            print('Expection', e)
 
 
 def main():
     global discovery_list
+    global frame_cache
     global sock
-    discovery_list = {}
+    parser = argparse.ArgumentParser(description='Query the local network for uHej services')
+    parser.add_argument('-i', '--iface', help="Query on this network interface (name or IP address)")
+    args = parser.parse_args()
+
+    discovery_list = set()
+    frame_cache = FrameCache()
 
     ANY = "0.0.0.0"
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -55,13 +66,14 @@ def main():
     thread.daemon = True
     thread.start()
 
-    if 0:
+    host = ANY
+    if args.iface:
         try:
-            host = socket.gethostbyname(socket.gethostname()+".local")
-        except:
-            host = socket.gethostbyname(socket.gethostname())
+            host = interface_ip(args.iface)
+        except ValueError as e:
+            parser.error(str(e))
         sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
-    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(ANY))
+    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(host))
 
     run_time_s = 10 # Run query for this many seconds
     query_interval_s = 2 # Send query this often
@@ -82,6 +94,7 @@ def main():
         print("1 service found")
     else:
         print("%d services found" % (num_found))
+    print("%d frames decoded, %d duplicates skipped" % (frame_cache.misses, frame_cache.hits))
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -51,6 +51,16 @@ UDP = 0
 TCP = 1
 MCAST = 2
 
+INADDR_ANY = "0.0.0.0"
+
+# Linux ioctls and flags used to enumerate interfaces
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFADDR = 0x8915
+_IFF_UP = 0x1
+_IFF_LOOPBACK = 0x8
+
+_interfaces = None  # Cached result of get_interfaces()
+
 
 class IllegalFrameException(Exception):
     pass
@@ -63,39 +73,49 @@ def ip2int(addr):
 def int2ip(addr):                                                               
     return socket.inet_ntoa(struct.pack("!I", addr))                            
 
-# Decode a received frame as an uhej frame (a byte array)
+# Precompiled codecs for the fixed size parts of the frames (network byte order)
+_HEADER = struct.Struct("!IB")      # magic, frame type
+_HELLO = struct.Struct("!I4s6B")    # node id, ip, mac
+_SERVICE = struct.Struct("!BH")     # service type, port
+_QUERY = struct.Struct("!B")        # service type
+
+# Decode a received frame as an uhej frame (bytes, bytearray or memoryview)
 # Raises IllegalFrameException if the frame is not a valud uhej frame
 def decode_frame(frame):
-    f = {}
+    frame = _as_buffer(frame)
     try:
-        magic = _decode_int32(frame, 0)
-        if MAGIC != magic:
-            raise IllegalFrameException
-        type = frame[4]
-        if HELLO == type:
-            f = _decode_hello(frame)
-        elif ANNOUNCE == type:
-            f = _decode_announce(frame)
-        elif QUERY == type:
-            f = _decode_query(frame)
-        elif BEACON == type:
-            f = _decode_beacon(frame)
-        else:
+        magic, type = _HEADER.unpack_from(frame, 0)
+        decoder = _decoders.get(type)
+        if MAGIC != magic or decoder is None:
             raise IllegalFrameException
-    except IndexError as e:
-        print("Index error")
+        return decoder(frame)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise IllegalFrameException
+
+# Return the type of a received frame without decoding it
+# Raises IllegalFrameException if the frame is not a valud uhej frame
+def frame_type(frame):
+    try:
+        magic, type = _HEADER.unpack_from(frame, 0)
+    except struct.error:
+        raise IllegalFrameException
+    if MAGIC != magic:
+        raise IllegalFrameException
+    return type
+
+# Decode the services of an announce frame as a tuple of (type, port, name)
+# tuples. Cheaper than decode_frame when only the services are of interest.
+def decode_services(frame):
+    if ANNOUNCE != frame_type(frame):
+        raise IllegalFrameException
+    try:
+        return tuple(_iter_services(_as_buffer(frame)))
+    except (struct.error, UnicodeDecodeError):
         raise IllegalFrameException
-    return f
 
 # Create and return a frame (a byte array) with given type (UDP, TCP or MCAST)
 def create_frame(type):
-    frame = bytearray()
-    frame.append((MAGIC>>24) & 0xff)
-    frame.append((MAGIC>>16) & 0xff)
-    frame.append((MAGIC>>8) & 0xff)
-    frame.append((MAGIC) & 0xff)
-    frame.append(type & 0xff)
-    return frame
+    return bytearray(_HEADER.pack(MAGIC, type & 0xff))
 
 # Add byte array payload to frame, return new frame
 def add_payload(frame, payload):
@@ -106,40 +126,18 @@ def add_payload(frame, payload):
 # Create and return a hello frame
 def hello(node_id, ip_addr_str, macaddr_str, name):
     f = create_frame(HELLO)
-    p = bytearray()
-    ip = ip2int(ip_addr_str)
-
-    # Append node id
-    p.append((node_id>>24) & 0xff)
-    p.append((node_id>>16) & 0xff)
-    p.append((node_id>>8) & 0xff)
-    p.append((node_id) & 0xff)
-
-    # Append IP
-    p.append((ip>>24) & 0xff)
-    p.append((ip>>16) & 0xff)
-    p.append((ip>>8) & 0xff)
-    p.append((ip) & 0xff)
-
-    # Apped MAC address
-    for b in macaddr_str.split(":"):
-        p.append(int(b, 16))
-
-    # Append node name
-    p.extend(name.encode('ascii'))
-    p.append(0)
-
-    f = add_payload(f, p)
+    mac = [int(b, 16) for b in macaddr_str.split(":")]
+    f += _HELLO.pack(node_id & 0xffffffff, socket.inet_aton(ip_addr_str), *mac)
+    f += name.encode('ascii')
+    f.append(0)
     return f
 
 # Create and return a query framefor a service of type UDP, TCP or MULTICAST with given name
 def query(type, name):
     f = create_frame(QUERY)
-    p = bytearray()
-    p.append(type & 0xff)
-    p.extend(name.encode('ascii'))
-    p.append(0)
-    f = add_payload(f, p)
+    f += _QUERY.pack(type & 0xff)
+    f += name.encode('ascii')
+    f.append(0)
     return f
 
 # Create and return an announce frame. Services is an array each item being a dictionary of
@@ -148,86 +146,160 @@ def query(type, name):
 # 'name' : string   name of servier
 def announce(services):
     f = create_frame(ANNOUNCE)
-    p = bytearray()
     for s in services:
-        p.append(s["type"] & 0xff)
-        p.append((s["port"]>>8) & 0xff)
-        p.append((s["port"]) & 0xff)
-        p.extend(s["name"].encode('ascii'))
-        p.append(0)
-    f = add_payload(f, p)
+        f += _SERVICE.pack(s["type"] & 0xff, s["port"] & 0xffff)
+        f += s["name"].encode('ascii')
+        f.append(0)
     return f
 
-# Create beacon frame. Will be used if beacons ever get implemented
-#def beacon():
-#    f = create_frame(BEACON)
-#    return f
+# Create and return a beacon frame. Servers send them to their subscribers and
+# subscribers echo them back, telling both ends the other one is still there.
+def beacon():
+    f = create_frame(BEACON)
+    return f
+
+# Return the local IPv4 interfaces as a list of dictionaries of
+# 'name'     : string   interface name (eg. "eth0")
+# 'ip'       : string   IPv4 address of the interface
+# 'up'       : bool     True if the interface is up
+# 'loopback' : bool     True for loopback interfaces
+# No name resolution is involved. The list is cached, pass refresh=True to
+# enumerate the interfaces again.
+def get_interfaces(refresh=False):
+    global _interfaces
+    if _interfaces is None or refresh:
+        _interfaces = _list_interfaces()
+    return list(_interfaces)
+
+# Return the IPv4 address of interface 'iface', given by name or address.
+# Without 'iface' the first interface that is up and not a loopback is used,
+# or INADDR_ANY leaving the choice to the kernel if there is none.
+# Raises ValueError if there is no such interface.
+def interface_ip(iface=None):
+    interfaces = get_interfaces()
+    if iface is None:
+        for i in interfaces:
+            if i['up'] and not i['loopback']:
+                return i['ip']
+        return INADDR_ANY
+    for i in interfaces:
+        if iface in (i['name'], i['ip']):
+            return i['ip']
+    try:
+        socket.inet_aton(iface)
+    except (socket.error, OSError):
+        raise ValueError("No such interface '%s'" % iface)
+    return iface  # An address we could not enumerate, let the kernel decide
 
 def get_local_ip():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(('8.8.8.8', 53))  # connecting to a UDP address doesn't send packets
-    local_ip_address = s.getsockname()[0]
-    return local_ip_address
+    ip = interface_ip()
+    return "127.0.0.1" if ip == INADDR_ANY else ip
 
 ### Internal functions below ###
 
-# Decode an int32 in network byte order in the byte array 'data' startging at 'offset'
-def _decode_int32(data, offset):
-    return (data[offset] << 24) | (data[offset+1] << 16) | (data[offset+2] << 8) | (data[offset+3])
-
-# Decode an int16 in network byte order in the byte array 'data' startging at 'offset'
-def _decode_int16(data, offset):
-    return (data[offset] << 8) | (data[offset+1])
-
-# Find the nexto zero byte in the byte array 'data' starting at 'start'
-# Return found location or -1 if none found
-def _find_zero(data, start):
-    i = start
-    while i < len(data):
-        if data[i] == 0:
-            return i;
-        i += 1
+# Enumerate the IPv4 interfaces with ioctls on Linux. Elsewhere ask the
+# routing table which address multicast goes out from, connecting a UDP
+# socket sends nothing.
+def _list_interfaces():
+    interfaces = []
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            import fcntl
+            names = [name for index, name in socket.if_nameindex()]
+        except (ImportError, AttributeError, OSError):
+            names = []
+        for name in names:
+            ifreq = struct.pack("256s", name[:15].encode())
+            try:
+                flags = struct.unpack_from("H", fcntl.ioctl(s.fileno(), _SIOCGIFFLAGS, ifreq), 16)[0]
+                addr = fcntl.ioctl(s.fileno(), _SIOCGIFADDR, ifreq)[20:24]
+            except (IOError, OSError):
+                continue  # No IPv4 address
+            interfaces.append({'name': name, 'ip': socket.inet_ntoa(addr),
+                               'up': bool(flags & _IFF_UP), 'loopback': bool(flags & _IFF_LOOPBACK)})
+        if not interfaces:
+            try:
+                s.connect((MCAST_GRP, MCAST_PORT))
+                ip = s.getsockname()[0]
+                if ip != INADDR_ANY:
+                    interfaces.append({'name': ip, 'ip': ip, 'up': True, 'loopback': ip.startswith("127.")})
+            except (socket.error, OSError):
+                pass
+    finally:
+        s.close()
+    return interfaces
+
+# Return bytes and bytearray as they are and anything else as a memoryview of
+# bytes, without copying the frame
+def _as_buffer(frame):
+    if isinstance(frame, (bytes, bytearray)):
+        return frame
+    frame = memoryview(frame)
+    return frame if frame.format == 'B' else frame.cast('B')
+
+# Return the index of the first zero byte in 'frame' from 'start', -1 if none.
+# memoryview has no find(), names are short enough to walk them instead.
+def _find_nul(frame, start):
+    if not isinstance(frame, memoryview):
+        return frame.find(b"\0", start)
+    for i in range(start, len(frame)):
+        if frame[i] == 0:
+            return i
     return -1
 
+# Yield (type, port, name) for each service in an announce frame
+def _iter_services(frame):
+    i = _HEADER.size
+    length = len(frame)
+    while i < length:
+        type, port = _SERVICE.unpack_from(frame, i)
+        start = i + _SERVICE.size
+        end = _find_nul(frame, start)
+        if end < 0:
+            raise IllegalFrameException
+        yield type, port, str(frame[start:end], "utf8")
+        i = end + 1
+
+# Return the string ending the frame at 'start', without its zero terminator
+def _tail_str(frame, start, encoding):
+    return str(frame[start:-1 if frame[-1] == 0 else len(frame)], encoding)
+
 # Decode a 'hello' frame
 def _decode_hello(frame):
     f = {}
-    f['frame_type'] = frame[4]
-    f['node_id'] = _decode_int32(frame, 5)
-    f['ip'] = int2ip(_decode_int32(frame, 9))
-    f['mac'] = "%02x:%02x:%02x:%02x:%02x:%02x" % (frame[13], frame[14], frame[15], frame[16], frame[17], frame[18])
-    f['name'] = frame[19:-1].decode("ascii")
+    fields = _HELLO.unpack_from(frame, _HEADER.size)
+    f['frame_type'] = HELLO
+    f['node_id'] = fields[0]
+    f['ip'] = socket.inet_ntoa(fields[1])
+    f['mac'] = "%02x:%02x:%02x:%02x:%02x:%02x" % fields[2:8]
+    f['name'] = _tail_str(frame, _HEADER.size + _HELLO.size, "ascii")
     return f
 
 # Decode a 'announce' frame
 def _decode_announce(frame):
     f = {}
-    f['frame_type'] = frame[4]
-    i = 5
-    services = []
-    while i < len(frame):
-        s = {}
-        s['type'] = frame[i]
-        s['port'] = _decode_int16(frame, i+1)
-        j = _find_zero(frame, i+3)
-        s['service_name'] = frame[i+3:j].decode("utf8") 
-        i = j + 1
-        services.append(s)
-
-    f['services'] = services
-
+    f['frame_type'] = ANNOUNCE
+    f['services'] = [{'type': type, 'port': port, 'service_name': name} for type, port, name in _iter_services(frame)]
     return f
 
 # Decode a 'query' frame
 def _decode_query(frame):
     f = {}
-    f['frame_type'] = frame[4]
+    f['frame_type'] = QUERY
     f['service_type'] = frame[5]
-    f['service_name'] = frame[6:-1].decode("utf8") 
+    f['service_name'] = _tail_str(frame, _HEADER.size + _QUERY.size, "utf8")
     return f
 
 # Decode a 'beacon' frame
 def _decode_beacon(frame):
     f = {}
-    f['frame_type'] = frame[4]
+    f['frame_type'] = BEACON
     return f
+
+_decoders = {
+    HELLO: _decode_hello,
+    ANNOUNCE: _decode_announce,
+    QUERY: _decode_query,
+    BEACON: _decode_beacon,
+}
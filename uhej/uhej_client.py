@@ -32,182 +32,229 @@ if sys.version[0] == '2':
 else:
     import queue as Queue
 from uhej import *
+from uhregistry import ServiceRegistry
+from uhloop import TimerWheel
 import logging
 
 rx_timeout_s = 1
-beacon_timeout_s = 5
+beacon_timeout_s = 15  # A service is lost when its server has not sent a beacon for this long
 query_time_s = 2
 
 logger = logging.getLogger(__name__)
 
-# Array of services we subscribe to, each item being a dictionary with the items:
+_service_types = ["UDP", "TCP", "Multicast"]
+
+
+# A uHej client tracking the services it subscribes to. The services are kept
+# in a ServiceRegistry, each service being a dictionary with the items:
 # "name"       : string     - name of service
 # "type"       : int        - type of service (uhej.UDP, uhej.TCP, uhej.MCAST)
 # "subscribed" : bool       - True if we are subscribed to a service
 # "timestamp"  : integer    - Unix timestamp of last beacon
 # "addr"       : ip address - IP address of server where we found the subscription
 # "port"       : integer    - port of server where we found the subscription
-service_list = [] # Array of service dictionaties
+#
+# callback(name, addr, port, is_subscribed) is called when a subscribed
+# service is found, and with addr and port set to None when it is lost.
+# Servers send beacons to their subscribers and the client echoes them back,
+# a service is lost when its server has been silent for beacon_timeout_s.
+# Servers that never sent a beacon (older servers) are never declared lost.
+class Client(object):
 
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.registry = ServiceRegistry()
+        self._rx_sock = None
+        self._tx_sock = None
+        self._q = None
+        self._loss_wheel = TimerWheel(rx_timeout_s)  # server address -> time to check for beacons
 
-def init(callback, node_id, ip, mac, name):
-    global _callback
-    _callback = callback
-    print("uHej client '%s on %s:%d" % (name, MCAST_GRP, MCAST_PORT))
-    _sock_init()
-    _queue_init()
-    _thread_init()
-    f = hello(node_id, ip, mac, name)
-    tx_sock.sendto(f, (MCAST_GRP, MCAST_PORT))
+    # Start the client. Without a loop the client runs in two threads of its
+    # own, with an uhloop.EventLoop it runs in the thread running the loop.
+    # 'iface' picks the multicast interface by name or address, see
+    # uhej.interface_ip().
+    def start(self, node_id, ip, mac, name, loop=None, iface=None):
+        print("uHej client '%s on %s:%d" % (name, MCAST_GRP, MCAST_PORT))
+        self._sock_init(iface)
+        if loop is None:
+            self._q = Queue.Queue()
+            self._thread_init()
+        else:
+            loop.add_datagram_reader(self._rx_sock, self._handle_datagram)
+            loop.call_every(rx_timeout_s, self._janitor)
+        f = hello(node_id, ip, mac, name)
+        self._tx_sock.sendto(f, (MCAST_GRP, MCAST_PORT))
 
-def subscribe_udp(service_name):
-    logger.info("Subscribing to UDP service '%s'" % (service_name))
-    service_list.append({'type':UDP, 'name':service_name, 'subscribed':False, 'timestamp':0, 'addr':None, 'port':None})
+    def subscribe_udp(self, service_name):
+        logger.info("Subscribing to UDP service '%s'" % (service_name))
+        self.registry.add({'type':UDP, 'name':service_name, 'subscribed':False, 'timestamp':0, 'addr':None, 'port':None})
 
-def cancel_udp(service_name):
-    for service in service_list:
-        if service["name"] == service_name:
+    def cancel_udp(self, service_name):
+        if self.registry.remove(service_name, UDP) is not None:
             logger.info("Cancelling UDP service '%s'" % (service_name))
-            service_list.remove(service)
 
-def find_service(name, type):
-    for service in service_list:
-        if service["name"] == name and service["type"] == type:
-            return service
-    return None
+    def find_service(self, name, type):
+        return self.registry.get(name, type)
 
-### Private functions below ###
+    ### Private functions below ###
+
+    def _check_service_announcement(self, frame):
+        addr = frame["source"]
+        for ann_service in frame["services"]:
+            name = ann_service["service_name"]
+            type = ann_service["type"]
+            port = ann_service["port"]
+            service = self.registry.get(name, type)
+            if None != service:
+                if not service["subscribed"]:
+                    logger.info("Found %s service '%s' at %s:%d" % (_service_types[type], name, addr, port))
+                    self.callback(name, addr, port, True)
+                service["subscribed"] = True
+                service["timestamp"] = time.time()
+                service["port"] = port
+                self.registry.set_addr(service, addr)
 
-def _check_service_announcement(frame):
-    global _callback
-    addr = frame["source"]
-    services = ["UDP", "TCP", "Multicast"]
-    for ann_service in frame["services"]:
-        name = ann_service["service_name"]
-        type = ann_service["type"]
-        port = ann_service["port"]
-        service = find_service(name, type)
-        if None != service:
-            if not service["subscribed"]:
-                logger.info("Found %s service '%s' at %s:%d" % (services[type], name, addr, port))
-                _callback(name, addr, port, True)
-            service["subscribed"] = True
-            service["timestamp"] = time.time()
-            service["addr"] = addr
-            service["port"] = port
-
-def _check_beacon(frame):
-    global _callback
-    match = False
-    addr = frame["source"]
-    for service in service_list:
-        if service["addr"] == addr:
+    def _check_beacon(self, frame):
+        match = False
+        addr = frame["source"]
+        for service in self.registry.by_addr(addr):
             if service["subscribed"]:
-                logger.info("Beacon from %s service '%s'" % (addr, service["name"]))
+                logger.debug("Beacon from %s service '%s'" % (addr, service["name"]))
                 service["timestamp"] = time.time()
                 match = True
             else:
                 logger.warning("Beacon from %s for unsubscribed service '%s'" % (addr, service["name"]))
-    if not match:
-        logger.warning("Unknown beacon from %s" % (addr))
-
-def _janitor():
-    global _callback
-    global tx_sock
-    services = ["UDP", "TCP", "Multicast"]
-    for service in service_list:
-        if not service["subscribed"] and time.time() - service["timestamp"] > query_time_s:
-            logger.info("Querying %s service '%s'" % (services[service["type"]], service["name"]))
-            f = query(service["type"], service["name"])
-            tx_sock.sendto(f, (MCAST_GRP, MCAST_PORT))
-
-#   TODO, someday when I introduct beacons between a client and the service it subscribes to
-
-#        elif service["subscribed"]:
-#            if time.time() - service["timestamp"] > 2*beacon_timeout_s:
-#                logger.info("Lost '%s'" % (service["name"]))
-#                _callback(service["name"], None, None, False)
-#                service["subscribed"] = False
-#            elif time.time() - service["timestamp"] > beacon_timeout_s:
-#                service["timestamp"] = time.time()
-#                logger.info("Beacon to %s:%d" % (service["addr"], MCAST_PORT))
-#                f = beacon()
-#                tx_sock.sendto(f, (service["addr"], MCAST_PORT))
-
-
-
-def _comms_thread():
-    global rx_sock
-    global q
-    logger.info("uHej server thread")
-    while 1:
+        if not match:
+            logger.warning("Unknown beacon from %s" % (addr))
+        else:
+            # Echo it back so the server knows we are still subscribing
+            self._tx_sock.sendto(beacon(), (addr, frame["port"]))
+            # Only servers that beacon can be watched for silence
+            if addr not in self._loss_wheel:
+                self._loss_wheel.schedule(addr, beacon_timeout_s)
+
+    # Check that the server at 'addr' sent a beacon within beacon_timeout_s,
+    # if it did not its services are lost
+    def _check_loss(self, addr):
+        services = [s for s in self.registry.by_addr(addr) if s["subscribed"]]
+        if not services:
+            return
+        silent_s = time.time() - max(s["timestamp"] for s in services)
+        if silent_s < beacon_timeout_s:
+            self._loss_wheel.schedule(addr, beacon_timeout_s - silent_s)
+            return
+        for service in services:
+            logger.info("Lost '%s' at %s" % (service["name"], addr))
+            service["subscribed"] = False
+            service["timestamp"] = 0
+            service["port"] = None
+            self.registry.set_addr(service, None)
+            self.callback(service["name"], None, None, False)
+
+    def _janitor(self):
+        for service in self.registry.services():
+            if not service["subscribed"] and time.time() - service["timestamp"] > query_time_s:
+                logger.info("Querying %s service '%s'" % (_service_types[service["type"]], service["name"]))
+                service["timestamp"] = time.time()
+                f = query(service["type"], service["name"])
+                self._tx_sock.sendto(f, (MCAST_GRP, MCAST_PORT))
+
+        for addr in self._loss_wheel.advance():
+            self._check_loss(addr)
+
+    def _comms_thread(self):
+        logger.info("uHej server thread")
+        while 1:
+            try:
+                data, addr = self._rx_sock.recvfrom(1024)
+                self._q.put((addr, data))
+            except Exception as e:
+                logger.error("Exception")
+
+    # Handle received datagrams, running the janitor every rx_timeout_s even
+    # when datagrams keep arriving
+    def _worker_thread(self):
+        logger.info("uHej worker thread")
+        next_tick = time.monotonic() + rx_timeout_s
+        while 1:
+            data = addr = None
+            try:
+                addr, data = self._q.get(timeout = max(0, next_tick - time.monotonic()))
+            except Queue.Empty:
+                pass
+            if data != None and addr != None:
+                self._handle_datagram(data, addr)
+            if time.monotonic() >= next_tick:
+                self._janitor()
+                next_tick += rx_timeout_s
+                if next_tick < time.monotonic():
+                    next_tick = time.monotonic() + rx_timeout_s
+
+    def _handle_datagram(self, data, addr):
+        port = addr[1]
+        addr = addr[0]
         try:
-            data, addr = rx_sock.recvfrom(1024)
-            q.put((addr, data))
-        except Exception as e:
-            logger.error("Exception")
-
-def _worker_thread():
-    global q
-    logger.info("uHej worker thread")
-    while 1:
-        data = addr = None
+            f = decode_frame(data)
+            f["source"] = addr
+            f["port"] = port
+            if ANNOUNCE == f["frame_type"]:
+                logger.info("Announce frame from %s:%d" % (f["source"], f["port"]))
+                self._check_service_announcement(f)
+            elif HELLO == f["frame_type"]:
+                logger.info("Hello frame")
+            elif BEACON == f["frame_type"]:
+                logger.debug("Beacon frame")
+                self._check_beacon(f)
+
+        except IllegalFrameException as e:
+            logger.info("%s:%d Illegal frame '%s'" % (addr, port, binascii.hexlify(data)))
+
+    def _thread_init(self):
+        _start_thread(self._comms_thread)
+        _start_thread(self._worker_thread)
+
+    def _sock_init(self, iface):
+        ANY = "0.0.0.0"
+        rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         try:
-            addr, data = q.get(timeout = rx_timeout_s)
-        except Queue.Empty:
-            _janitor()
-        if data != None and addr != None:
-            port = addr[1]
-            addr = addr[0]
-            frame = bytearray(data)
-            try:
-                f = decode_frame(frame)
-                f["source"] = addr
-                f["port"] = port
-                if ANNOUNCE == f["frame_type"]:
-                    logger.info("Announce frame from %s:%d" % (f["source"], f["port"]))
-                    _check_service_announcement(f)
-                elif HELLO == f["frame_type"]:
-                    logger.info("Hello frame")
-                elif BEACON == f["frame_type"]:
-                    logger.info("Beacon frame")
-                    _check_beacon(f)
-
-            except IllegalFrameException as e:
-                logger.info("%s:%d Illegal frame '%s'" % (addr, port, frame))
+            rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        except AttributeError:
+            pass
+        rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32) 
+        rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        rx_sock.bind((ANY, MCAST_PORT))
+        host = interface_ip(iface)
+        rx_sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(host))
+        self._rx_sock = rx_sock
+
+        # Hellos and queries go out here, on the same interface
+        self._tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._tx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+        self._tx_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
+
+
+# The module level functions below drive a default client, for scripts that
+# only need one
+_client = Client()
+
+def init(callback, node_id, ip, mac, name, loop=None, iface=None):
+    _client.callback = callback
+    _client.start(node_id, ip, mac, name, loop, iface)
+
+def subscribe_udp(service_name):
+    _client.subscribe_udp(service_name)
+
+def cancel_udp(service_name):
+    _client.cancel_udp(service_name)
+
+def find_service(name, type):
+    return _client.find_service(name, type)
+
+### Private functions below ###
 
 def _start_thread(thread):
     thread = threading.Thread(target = thread)
     thread.daemon = True
     thread.start()
 
-def _thread_init():
-    _start_thread(_comms_thread)
-    _start_thread(_worker_thread)
-
-def _queue_init():
-    global q
-    q = Queue.Queue()
-
-def _sock_init():
-    global rx_sock
-    global tx_sock
-    ANY = "0.0.0.0"
-    rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    try:
-        rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    except AttributeError:
-        pass
-    rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32) 
-    rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
-
-    rx_sock.bind((ANY, MCAST_PORT))
-    try:
-        host = socket.gethostbyname(socket.gethostname())
-    except:
-        host = socket.gethostbyname(socket.gethostname()+".local")
-    rx_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
-    rx_sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(ANY))
-
-    tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    tx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
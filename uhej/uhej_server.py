@@ -26,170 +26,339 @@ import time
 import threading
 import socket
 import binascii
+import collections
 import sys
 if sys.version[0] == '2':
     import Queue
 else:
     import queue as Queue
 from uhej import *
+from uhregistry import ServiceRegistry, SubscriberTable
+from uhloop import TimerWheel
 import logging
 
 rx_timeout_s = 1
+beacon_interval_s = 5  # Send a beacon to each subscriber this often
+subscriber_ttl_s = 60  # Forget subscribers that have not queried or echoed a beacon for this long
+max_subscribers = 256  # Max subscribers tracked per service
+query_rate = 5.0       # Queries per second answered per source, on average
+query_burst = 10       # Queries answered per source in a burst
+coalesce_s = 0.5       # Answer identical queries from a source once within this window
+max_sources = 1024     # Max query sources tracked for rate limiting and coalescing
 
 logger = logging.getLogger(__name__)
 
-# Array of dictionaries
+_service_types = ["UDP", "TCP", "Multicast"]
+
+
+# A uHej server announcing services and sending beacons to the hosts
+# subscribing to them. The services are kept in a
+# ServiceRegistry, each service being a dictionary of
 # 'name' : string   name of service
 # 'type' : int8     type of service (uhej_protocol.UDP, uhej_protocol.TCP, uhej_protocol.MCAST)
 # 'port' : int16    port where service is located
 # 'ip'   : int32    ip (for multicast services)
-# 'subscribers'   : array   array of ip addresses subscribing to this service
-service_list = []
+# 'subscribers'   : SubscriberTable   ip addresses subscribing to this service
+class Server(object):
 
+    def __init__(self):
+        self.registry = ServiceRegistry()
+        self._rx_sock = None
+        self._tx_sock = None
+        self._q = None
+        self._limiter = QueryLimiter(query_rate, query_burst, coalesce_s, max_sources)
+        self._announce_cache = {}  # '*' or (name, type) -> encoded announce frame
+        self._announce_generation = None
+        self._beacon_wheel = TimerWheel(rx_timeout_s)  # subscriber address -> time of next beacon
+        self.counters = {'queries': 0, 'answered': 0, 'rate_limited': 0, 'coalesced': 0, 'encoded': 0,
+                         'beacons_sent': 0, 'beacons_received': 0}
 
-def init():
-    _sock_init()
-    _queue_init()
-    _thread_init()
+    # Start the server. Without a loop the server runs in two threads of its
+    # own, with an uhloop.EventLoop it runs in the thread running the loop.
+    # 'iface' picks the multicast interface by name or address, see
+    # uhej.interface_ip().
+    def start(self, loop=None, iface=None):
+        self._sock_init(iface)
+        if loop is None:
+            self._q = Queue.Queue()
+            self._thread_init()
+        else:
+            loop.add_datagram_reader(self._rx_sock, self._handle_datagram)
+            loop.add_datagram_reader(self._tx_sock, self._handle_datagram)
+            loop.call_every(rx_timeout_s, self._janitor)
 
-def announce_udp(service_name, port):
-    logger.info("Advertising UDP '%s' on port %d" % (service_name, port))
-    service_list.append({'type':UDP, 'name':service_name, 'port':port, 'subscribers':[]})
+    def announce_udp(self, service_name, port):
+        logger.info("Advertising UDP '%s' on port %d" % (service_name, port))
+        self.registry.add({'type':UDP, 'name':service_name, 'port':port, 'subscribers':_subscriber_table()})
 
-def announce_tcp(service_name, port):
-    logger.info("Advertising TCP service '%s' on port %d" % (service_name, port))
-    service_list.append({'type':TCP, 'name':service_name, 'port':port, 'subscribers':[]})
+    def announce_tcp(self, service_name, port):
+        logger.info("Advertising TCP service '%s' on port %d" % (service_name, port))
+        self.registry.add({'type':TCP, 'name':service_name, 'port':port, 'subscribers':_subscriber_table()})
 
-def announce_mcast(service_name, ip, port):
-    logger.info("Advertising multicast service '%s' on %s:%d" % (service_name, ip, port))
-    service_list.append({'type':MCAST, 'name':service_name, 'port':port, 'ip':ip, 'subscribers':[]})
+    def announce_mcast(self, service_name, ip, port):
+        logger.info("Advertising multicast service '%s' on %s:%d" % (service_name, ip, port))
+        self.registry.add({'type':MCAST, 'name':service_name, 'port':port, 'ip':ip, 'subscribers':_subscriber_table()})
 
-def cancel_udp(name):
-    _cancel(name, UDP)
+    def cancel_udp(self, name):
+        self._cancel(name, UDP)
 
-def cancel_tcp(name):
-    _cancel(name, TCP)
-
-def cancel_mcast(name):
-    _cancel(name, MCAST)
+    def cancel_tcp(self, name):
+        self._cancel(name, TCP)
 
+    def cancel_mcast(self, name):
+        self._cancel(name, MCAST)
 
+    # Return the subscriber and query counters, summed over all services
+    def stats(self):
+        total = {}
+        for service in self.registry.services():
+            for key, value in service["subscribers"].stats().items():
+                total[key] = total.get(key, 0) + value
+        total["services"] = len(self.registry)
+        total.update(self.counters)
+        return total
 
-### Private functions below ###
+    ### Private functions below ###
 
-def _cancel(name, type):
-    for service in service_list:
-        if service["name"] == name and service["type"] == type:
+    def _cancel(self, name, type):
+        if self.registry.remove(name, type) is not None:
             logger.info("Cancelling '%s' [%s]" % (name, type))
-            service_list.remove(service)
-
-def _janitor():
-    global tx_sock
-
-#   TODO, someday when I introduct beacons between a client and the service it subscribes to
-#    for service in service_list:
-#        for client in service["subscribers"]:
-#            f = beacon()
-#            logger.info("Beacon to %s" % client)
-#            tx_sock.sendto(f, (client, MCAST_PORT))
-
-def _comms_thread():
-    global rx_sock
-    global q
-    logger.info("uHej server thread")
-    while 1:
-        try:
-            data, addr = rx_sock.recvfrom(1024)
-            q.put((addr, data))
-        except Exception as e:
-            logger.error("Exception")
-            raise e
 
-def _check_query(frame):
-    services = ["UDP", "TCP", "Multicast"]
-    if frame["service_name"] == "*":
-        logger.info("Answering service wildcard")
-        a = announce(service_list)
+    def _janitor(self):
+        for service in self.registry.services():
+            count = service["subscribers"].expire()
+            if count:
+                logger.info("Expired %d subscriber(s) of '%s'" % (count, service["name"]))
+        self._send_beacons()
+
+    # Send a beacon to each subscriber whose beacon is due. Beacons go out
+    # from the tx socket, subscribers echo them back to it.
+    def _send_beacons(self):
+        for client in self._beacon_wheel.advance():
+            if not self._is_subscriber(client):
+                continue
+            logger.debug("Beacon to %s" % client)
+            self._beacon_wheel.schedule(client, beacon_interval_s)
+            try:
+                self._tx_sock.sendto(beacon(), (client, MCAST_PORT))
+                self.counters['beacons_sent'] += 1
+            except IOError as e:
+                logger.warning("Beacon to %s failed: %s" % (client, e))
+
+    def _is_subscriber(self, addr):
+        for service in self.registry.services():
+            if addr in service["subscribers"]:
+                return True
+        return False
+
+    # A subscriber echoed a beacon, it is still there
+    def _check_beacon(self, frame):
+        self.counters['beacons_received'] += 1
+        source = frame["source"]
+        match = False
+        for service in self.registry.services():
+            if source in service["subscribers"]:
+                service["subscribers"].touch(source)
+                match = True
+        if not match:
+            logger.info("Beacon from %s, not a subscriber" % (source))
+
+    def _comms_thread(self, sock):
+        logger.info("uHej server thread")
+        while 1:
+            try:
+                data, addr = sock.recvfrom(1024)
+                self._q.put((addr, data))
+            except Exception as e:
+                logger.error("Exception")
+                raise e
+
+    def _check_query(self, frame):
+        self.counters['queries'] += 1
+        source = frame["source"]
+        if frame["service_name"] == "*":
+            key = "*"
+        else:
+            key = (frame["service_name"], frame["service_type"])
+            service = self.registry.get(*key)
+            if service is None:
+                return
+            service["subscribers"].expire()
+            service["subscribers"].touch(source)
+            if source not in self._beacon_wheel:
+                self._beacon_wheel.schedule(source, beacon_interval_s)
+        verdict = self._limiter.check(source, key)
+        if verdict is not None:
+            self.counters[verdict] += 1
+            return
+        if key == "*":
+            logger.info("Answering service wildcard")
+        else:
+            logger.info("Answering %s service '%s'" % (_service_types[frame["service_type"]], frame["service_name"]))
+        a = self._announce_frame(key)
+        self.counters['answered'] += 1
         try:
-            tx_sock.sendto(a, (frame["source"], MCAST_PORT))
+            self._tx_sock.sendto(a, (source, MCAST_PORT))
         except IOError as e:
             logger.warn("Got IOError ", e)
             raise e
-    else:
-        for service in service_list:
-            if service["name"] == frame["service_name"] and service["type"] == frame["service_type"]:
-                logger.info("Answering %s service '%s'" % (services[frame["service_type"]], frame["service_name"]))
-                a = announce([service])
-                service["subscribers"].append(frame["source"])
-                try:
-                    tx_sock.sendto(a, (frame["source"], MCAST_PORT))
-                except IOError as e:
-                    logger.warn("Got IOError ", e)
-                    raise e
-
-def _worker_thread():
-    global q
-    logger.info("uHej worker thread")
-    while 1:
-        data = addr = None
-        try:
-            addr, data = q.get(timeout = rx_timeout_s)
-        except Queue.Empty:
-            _janitor()
-        if data != None and addr != None:
-            port = addr[1]
-            addr = addr[0]
-            frame = bytearray(data)
+
+    # Return the announce frame answering a query for 'key', encoding it only
+    # if the services changed since it was last encoded
+    def _announce_frame(self, key):
+        generation = self.registry.generation
+        if generation != self._announce_generation:
+            self._announce_cache.clear()
+            self._announce_generation = generation
+        a = self._announce_cache.get(key)
+        if a is None:
+            if key == "*":
+                a = announce(self.registry.services())
+            else:
+                a = announce([self.registry.get(*key)])
+            a = bytes(a)
+            self._announce_cache[key] = a
+            self.counters['encoded'] += 1
+        return a
+
+    # Handle received datagrams, running the janitor every rx_timeout_s even
+    # when datagrams keep arriving
+    def _worker_thread(self):
+        logger.info("uHej worker thread")
+        next_tick = time.monotonic() + rx_timeout_s
+        while 1:
+            data = addr = None
             try:
-                services = ["UDP", "TCP", "Multicast"]
-                f = decode_frame(frame)
-                f["source"] = addr
-                f["port"] = port
-                hexdata = binascii.hexlify(data)
-                if QUERY == f["frame_type"]:
-                    logger.info("Query %s service '%s' from %s", services[f["service_type"]], f["service_name"], f["source"])
-                    _check_query(f)
-                elif HELLO == f["frame_type"]:
-                    logger.info("Hello from %s (%s)" % (f["source"], f["name"]))
-                else:
-                    logger.info("Unhandled frame type %d" % (f["frame_type"]))
-                    print(f)
-
-            except IllegalFrameException as e:
-                logger.info("%s:%d Illegal frame '%s'" % (addr, port, frame))
-
-def _start_thread(thread):
-    thread = threading.Thread(target = thread)
+                addr, data = self._q.get(timeout = max(0, next_tick - time.monotonic()))
+            except Queue.Empty:
+                pass
+            if data != None and addr != None:
+                self._handle_datagram(data, addr)
+            if time.monotonic() >= next_tick:
+                self._janitor()
+                next_tick += rx_timeout_s
+                if next_tick < time.monotonic():
+                    next_tick = time.monotonic() + rx_timeout_s
+
+    def _handle_datagram(self, data, addr):
+        port = addr[1]
+        addr = addr[0]
+        try:
+            f = decode_frame(data)
+            f["source"] = addr
+            f["port"] = port
+            if QUERY == f["frame_type"]:
+                logger.info("Query %s service '%s' from %s", _service_types[f["service_type"]], f["service_name"], f["source"])
+                self._check_query(f)
+            elif HELLO == f["frame_type"]:
+                logger.info("Hello from %s (%s)" % (f["source"], f["name"]))
+            elif BEACON == f["frame_type"]:
+                self._check_beacon(f)
+            else:
+                logger.info("Unhandled frame type %d" % (f["frame_type"]))
+                print(f)
+
+        except IllegalFrameException as e:
+            logger.info("%s:%d Illegal frame '%s'" % (addr, port, binascii.hexlify(data)))
+
+    def _thread_init(self):
+        _start_thread(self._comms_thread, self._rx_sock)
+        _start_thread(self._comms_thread, self._tx_sock)
+        _start_thread(self._worker_thread)
+
+    def _sock_init(self, iface):
+        ANY = "0.0.0.0"
+        rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        except AttributeError:
+            pass
+        rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32) 
+        rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+#        rx_sock.bind((ANY, MCAST_PORT))
+        rx_sock.bind((MCAST_GRP, MCAST_PORT))
+        host = interface_ip(iface)
+        rx_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
+        rx_sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(host))
+        self._rx_sock = rx_sock
+
+        self._tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._tx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+
+
+# Decides which queries get answered. Each source gets a token bucket holding
+# up to 'burst' tokens that refills at 'rate' tokens per second, and a query
+# identical to one answered less than 'coalesce_s' ago is answered only once.
+# At most 'max_sources' sources are tracked, the least recently seen being
+# forgotten first.
+class QueryLimiter(object):
+
+    def __init__(self, rate, burst, coalesce_s, max_sources):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_s = coalesce_s
+        self.max_sources = max_sources
+        self._sources = collections.OrderedDict()  # source -> [tokens, last refill, {key: time answered}]
+
+    # Return None if a query for 'key' from 'source' should be answered,
+    # otherwise the reason it should not ('rate_limited' or 'coalesced')
+    def check(self, source, key, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self._sources.get(source)
+        if entry is None:
+            if len(self._sources) >= self.max_sources:
+                self._sources.popitem(last=False)
+            entry = self._sources[source] = [self.burst, now, {}]
+        else:
+            self._sources.move_to_end(source)
+        tokens, last, answered = entry
+        answered_at = answered.get(key)
+        if answered_at is not None and now - answered_at < self.coalesce_s:
+            return 'coalesced'
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        entry[1] = now
+        if tokens < 1:
+            entry[0] = tokens
+            return 'rate_limited'
+        entry[0] = tokens - 1
+        if len(answered) > 16:
+            answered.clear()  # Someone is walking the service names, keep it small
+        answered[key] = now
+        return None
+
+
+# The module level functions below drive a default server, for scripts that
+# only need one
+_server = Server()
+
+def init(loop=None, iface=None):
+    _server.start(loop, iface)
+
+def announce_udp(service_name, port):
+    _server.announce_udp(service_name, port)
+
+def announce_tcp(service_name, port):
+    _server.announce_tcp(service_name, port)
+
+def announce_mcast(service_name, ip, port):
+    _server.announce_mcast(service_name, ip, port)
+
+def cancel_udp(name):
+    _server.cancel_udp(name)
+
+def cancel_tcp(name):
+    _server.cancel_tcp(name)
+
+def cancel_mcast(name):
+    _server.cancel_mcast(name)
+
+### Private functions below ###
+
+def _subscriber_table():
+    return SubscriberTable(subscriber_ttl_s, max_subscribers)
+
+def _start_thread(thread, *args):
+    thread = threading.Thread(target = thread, args = args)
     thread.daemon = True
     thread.start()
 
-def _thread_init():
-    _start_thread(_comms_thread)
-    _start_thread(_worker_thread)
-
-def _queue_init():
-    global q
-    q = Queue.Queue()
-
-def _sock_init():
-    global rx_sock
-    global tx_sock
-    ANY = "0.0.0.0"
-    rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    try:
-        rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    except AttributeError:
-        pass
-    rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32) 
-    rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
-#    rx_sock.bind((ANY, MCAST_PORT))
-    rx_sock.bind((MCAST_GRP, MCAST_PORT))
-    try:
-        host = socket.gethostbyname(socket.gethostname()+".local")
-    except:
-        host = socket.gethostbyname(socket.gethostname())
-    rx_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
-    rx_sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(MCAST_GRP) + socket.inet_aton(host))
-
-    tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    tx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
@@ -0,0 +1,203 @@
+"""
+ The MIT License (MIT)
+ 
+ Copyright (c) 2017 Johan Kanflo (github.com/kanflo)
+ 
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+ 
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+ 
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+
+import heapq
+import itertools
+import logging
+import math
+import selectors
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# A handle for a scheduled call, pass it to EventLoop.cancel() to cancel it
+class Timer(object):
+
+    def __init__(self, when, callback, args, interval):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+
+# A single threaded event loop running socket callbacks and timers.
+#
+# Sockets are watched with a selector and timers are kept in a heap ordered
+# by deadline, so the loop sleeps exactly until the next socket becomes
+# readable or the next timer is due. Repeating timers are rescheduled from
+# their previous deadline rather than from when they ran, so they stay on
+# schedule while the loop is busy receiving.
+class EventLoop(object):
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._timers = []
+        self._seq = itertools.count()  # Tie breaker for timers due at the same time
+        self._running = False
+
+    # Call callback(sock) whenever 'sock' becomes readable
+    def add_reader(self, sock, callback):
+        sock.setblocking(False)
+        self._selector.register(sock, selectors.EVENT_READ, callback)
+
+    # Call handler(data, addr) for each datagram received on 'sock'. At most
+    # 'batch' datagrams are handled per wakeup so timers are not starved.
+    def add_datagram_reader(self, sock, handler, batch=64, bufsize=1024):
+        def on_readable(sock):
+            for i in range(batch):
+                try:
+                    data, addr = sock.recvfrom(bufsize)
+                except (BlockingIOError, InterruptedError):
+                    return
+                handler(data, addr)
+        self.add_reader(sock, on_readable)
+
+    def remove_reader(self, sock):
+        self._selector.unregister(sock)
+
+    # Call callback(*args) once in 'delay_s' seconds
+    def call_later(self, delay_s, callback, *args):
+        return self._schedule(Timer(time.monotonic() + delay_s, callback, args, None))
+
+    # Call callback(*args) every 'interval_s' seconds, the first time in
+    # 'interval_s' seconds
+    def call_every(self, interval_s, callback, *args):
+        return self._schedule(Timer(time.monotonic() + interval_s, callback, args, interval_s))
+
+    # Cancel a timer returned by call_later() or call_every(). Cancelled
+    # timers are dropped when they reach the top of the heap.
+    def cancel(self, timer):
+        timer.cancelled = True
+
+    # Run the loop until stop() is called
+    def run(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    # Wait for and handle one round of socket events and due timers.
+    # 'timeout_s' caps the wait, None waits until something happens.
+    def run_once(self, timeout_s=None):
+        wait_s = self._next_timeout()
+        if timeout_s is not None and (wait_s is None or timeout_s < wait_s):
+            wait_s = timeout_s
+        for key, events in self._selector.select(wait_s):
+            self._run_callback(key.data, key.fileobj)
+        self._run_timers()
+
+    def close(self):
+        self._selector.close()
+        self._timers = []
+
+    ### Private functions below ###
+
+    def _schedule(self, timer):
+        heapq.heappush(self._timers, (timer.when, next(self._seq), timer))
+        return timer
+
+    def _next_timeout(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.when += timer.interval
+                if timer.when <= now:
+                    # We fell more than a period behind, skip the missed runs
+                    # instead of firing them back to back
+                    timer.when = now + timer.interval
+                self._schedule(timer)
+            self._run_callback(timer.callback, *timer.args)
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Exception in event loop callback %r" % (callback,))
+
+
+# A timer wheel for a large number of coarse deadlines, such as one per host
+# being watched for beacons. Keys are hashed into slots by their deadline tick
+# so scheduling, rescheduling and cancelling are O(1), and advance() only
+# looks at the slots passed since the last call. Deadlines further away than
+# one turn of the wheel stay in their slot until their turn comes. Keys never
+# fire early but may fire up to one tick late.
+class TimerWheel(object):
+
+    def __init__(self, tick_s=1.0, slots=64, now=None):
+        self.tick_s = tick_s
+        self._slots = [set() for i in range(slots)]
+        self._deadlines = {}  # key -> deadline tick
+        self._tick = self._tick_at(time.monotonic() if now is None else now)
+
+    # Schedule 'key' 'delay_s' seconds from now, replacing any earlier schedule
+    def schedule(self, key, delay_s, now=None):
+        now = time.monotonic() if now is None else now
+        self.cancel(key)
+        tick = max(self._tick + 1, int(math.ceil((now + delay_s) / self.tick_s)))
+        self._deadlines[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        tick = self._deadlines.pop(key, None)
+        if tick is not None:
+            self._slots[tick % len(self._slots)].discard(key)
+
+    # Return a list of the keys whose deadline has passed, they are no longer
+    # scheduled afterwards
+    def advance(self, now=None):
+        now = time.monotonic() if now is None else now
+        current = self._tick_at(now)
+        due = []
+        first = self._tick + 1
+        for tick in range(first, min(current, first + len(self._slots) - 1) + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key in [k for k in slot if self._deadlines[k] <= current]:
+                slot.discard(key)
+                del self._deadlines[key]
+                due.append(key)
+        self._tick = max(self._tick, current)
+        return due
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _tick_at(self, t):
+        return int(t / self.tick_s)
@@ -0,0 +1,187 @@
+"""
+ The MIT License (MIT)
+ 
+ Copyright (c) 2017 Johan Kanflo (github.com/kanflo)
+ 
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+ 
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+ 
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+
+# A registry of services indexed by (name, type) and by the address of the
+# host providing them. Each service is a dictionary with at least the items
+# 'name' : string   name of service
+# 'type' : int8     type of service (UDP, TCP or MCAST)
+# 'addr' : string   IP address of the host providing the service, or None
+# Other items belong to the owner of the registry and are left untouched.
+#
+# Lookups are O(1). services() and by_addr() return snapshots so the registry
+# may be changed by another thread while the caller iterates over them.
+class ServiceRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._services = {}  # (name, type) -> service
+        self._by_addr = {}   # addr -> {(name, type): service}
+        self.generation = 0  # Bumped whenever a service is added or removed
+
+    # Add a service, replacing any service with the same name and type.
+    # Returns the service.
+    def add(self, service):
+        service.setdefault('addr', None)
+        key = (service['name'], service['type'])
+        with self._lock:
+            old = self._services.get(key)
+            if old is not None:
+                self._unindex_addr(key, old['addr'])
+            self._services[key] = service
+            self._index_addr(key, service['addr'])
+            self.generation += 1
+        return service
+
+    # Remove a service, returns the removed service or None if not found
+    def remove(self, name, type):
+        key = (name, type)
+        with self._lock:
+            service = self._services.pop(key, None)
+            if service is not None:
+                self._unindex_addr(key, service['addr'])
+                self.generation += 1
+        return service
+
+    # Return the service with given name and type, or None
+    def get(self, name, type):
+        return self._services.get((name, type))
+
+    # Move a registered service to a new address
+    def set_addr(self, service, addr):
+        key = (service['name'], service['type'])
+        with self._lock:
+            if service['addr'] == addr:
+                return
+            if self._services.get(key) is service:
+                self._unindex_addr(key, service['addr'])
+                self._index_addr(key, addr)
+            service['addr'] = addr
+
+    # Return a list of the services provided by the host at 'addr'
+    def by_addr(self, addr):
+        with self._lock:
+            return list(self._by_addr.get(addr, {}).values())
+
+    # Return a list of all services
+    def services(self):
+        with self._lock:
+            return list(self._services.values())
+
+    def __contains__(self, key):
+        return key in self._services
+
+    def __len__(self):
+        return len(self._services)
+
+    def __iter__(self):
+        return iter(self.services())
+
+    ### Private functions below, called with the lock held ###
+
+    def _index_addr(self, key, addr):
+        if addr is not None:
+            self._by_addr.setdefault(addr, {})[key] = self._services[key]
+
+    def _unindex_addr(self, key, addr):
+        services = self._by_addr.get(addr)
+        if services is not None:
+            services.pop(key, None)
+            if not services:
+                del self._by_addr[addr]
+
+
+# A bounded table of the hosts subscribing to a service, keeping the time each
+# host was last seen. Hosts not seen for 'ttl_s' seconds are evicted by
+# expire(), and when the table is full the host seen longest ago makes room
+# for a new one, so memory stays flat no matter how often clients re-query.
+# The table is ordered by last seen time which makes touch(), expire() and
+# eviction O(1) per host.
+class SubscriberTable(object):
+
+    def __init__(self, ttl_s=60, max_size=256):
+        self.ttl_s = ttl_s
+        self.max_size = max_size
+        self._seen = collections.OrderedDict()  # addr -> monotonic time last seen
+        self.peak = 0       # Largest number of subscribers seen at once
+        self.added = 0      # New subscribers
+        self.refreshed = 0  # Queries from hosts already subscribing
+        self.expired = 0    # Subscribers evicted after ttl_s
+        self.dropped = 0    # Subscribers evicted to make room for new ones
+
+    # Record that 'addr' subscribed now
+    def touch(self, addr, now=None):
+        now = time.monotonic() if now is None else now
+        if addr in self._seen:
+            self._seen.move_to_end(addr)
+            self.refreshed += 1
+        else:
+            if len(self._seen) >= self.max_size:
+                self._seen.popitem(last=False)
+                self.dropped += 1
+            self.added += 1
+        self._seen[addr] = now
+        self.peak = max(self.peak, len(self._seen))
+
+    # Evict subscribers not seen within ttl_s, returns the number evicted
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        count = 0
+        while self._seen:
+            addr, last_seen = next(iter(self._seen.items()))
+            if now - last_seen <= self.ttl_s:
+                break
+            del self._seen[addr]
+            count += 1
+        self.expired += count
+        return count
+
+    def remove(self, addr):
+        self._seen.pop(addr, None)
+
+    # Return a dictionary of counters describing the table
+    def stats(self):
+        return {
+            'subscribers': len(self._seen),
+            'peak': self.peak,
+            'added': self.added,
+            'refreshed': self.refreshed,
+            'expired': self.expired,
+            'dropped': self.dropped,
+            'bytes': sys.getsizeof(self._seen) + sum(sys.getsizeof(a) for a in self._seen),
+        }
+
+    def __contains__(self, addr):
+        return addr in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __iter__(self):
+        return iter(list(self._seen))
@@ -0,0 +1,136 @@
+"""
+ The MIT License (MIT)
+
+ Copyright (c) 2017 Johan Kanflo (github.com/kanflo)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+
+import collections
+import time
+
+from uhej import HELLO, ANNOUNCE, QUERY, BEACON
+
+FRAME_TYPES = (HELLO, ANNOUNCE, QUERY, BEACON)
+FRAME_TYPE_NAMES = {HELLO: "hello", ANNOUNCE: "announce", QUERY: "query", BEACON: "beacon"}
+
+
+# Counts events in one second buckets over the last 'window_s' seconds.
+# Adding is O(1), rate() looks at the buckets of the requested span.
+class RateCounter(object):
+
+    def __init__(self, window_s=60):
+        self._counts = [0] * window_s
+        self._seconds = [-1] * window_s  # The second each bucket counts
+        self._first = None  # The second of the first event
+
+    def add(self, now, n=1):
+        second = int(now)
+        if self._first is None:
+            self._first = second
+        i = second % len(self._counts)
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._counts[i] = 0
+        self._counts[i] += n
+
+    # Return the average number of events per second over the last 'span_s'
+    # seconds (at most the window, and at most since the first event)
+    def rate(self, now, span_s):
+        if self._first is None:
+            return 0.0
+        second = int(now)
+        span_s = max(1, min(span_s, len(self._counts), second - self._first + 1))
+        total = 0
+        for i in range(len(self._counts)):
+            if second - span_s < self._seconds[i] <= second:
+                total += self._counts[i]
+        return float(total) / span_s
+
+
+# Traffic counters for one source address
+class SourceStats(object):
+
+    def __init__(self, source, window_s):
+        self.source = source
+        self.frames = 0
+        self.bytes = 0
+        self.illegal = 0
+        self.types = dict((t, 0) for t in FRAME_TYPES)
+        self.rate = RateCounter(window_s)
+        self.last_seen = 0
+
+
+# Per source and per frame type traffic statistics. Each frame is accounted
+# for in O(1). At most 'max_sources' sources are tracked, the one heard from
+# longest ago makes room for a new one, while the totals keep counting
+# everything. Memory use is bounded by max_sources * window_s.
+class TrafficStats(object):
+
+    def __init__(self, max_sources=256, window_s=60):
+        self.max_sources = max_sources
+        self.window_s = window_s
+        self._sources = collections.OrderedDict()  # source -> SourceStats, least recently seen first
+        self.total = SourceStats("total", window_s)
+        self.evicted = 0  # Sources forgotten to make room for new ones
+        self.started = time.monotonic()
+
+    # Account for a frame of 'size' bytes from 'source'. 'frame_type' is
+    # None for illegal frames.
+    def add(self, source, frame_type, size, now=None):
+        now = time.monotonic() if now is None else now
+        s = self._sources.get(source)
+        if s is None:
+            if len(self._sources) >= self.max_sources:
+                self._sources.popitem(last=False)
+                self.evicted += 1
+            s = self._sources[source] = SourceStats(source, self.window_s)
+        else:
+            self._sources.move_to_end(source)
+        for stats in (s, self.total):
+            stats.frames += 1
+            stats.bytes += size
+            stats.last_seen = now
+            stats.rate.add(now)
+            if frame_type is None:
+                stats.illegal += 1
+            elif frame_type in stats.types:
+                stats.types[frame_type] += 1
+            else:
+                stats.illegal += 1  # Unknown frame type
+
+    # Return the 'n' sources sending the most frames over the last 'span_s' seconds
+    def top(self, n=10, span_s=10, now=None):
+        now = time.monotonic() if now is None else now
+        return sorted(self._sources.values(), key=lambda s: (s.rate.rate(now, span_s), s.frames), reverse=True)[:n]
+
+    # Return a top talkers table as a string
+    def report(self, n=10, now=None):
+        now = time.monotonic() if now is None else now
+        header = "%-21s %9s %9s %9s" % ("source", "fps 10s", "fps 60s", "frames") + \
+                 "".join(" %9s" % FRAME_TYPE_NAMES[t] for t in FRAME_TYPES) + " %9s %11s" % ("illegal", "bytes")
+        lines = [header]
+        for s in self.top(n, 10, now) + [self.total]:
+            lines.append("%-21s %9.1f %9.1f %9d" % (s.source, s.rate.rate(now, 10), s.rate.rate(now, 60), s.frames) +
+                         "".join(" %9d" % s.types[t] for t in FRAME_TYPES) + " %9d %11d" % (s.illegal, s.bytes))
+        lines.append("%d sources tracked, %d forgotten, running for %.0f s" % (len(self._sources), self.evicted, now - self.started))
+        return "\n".join(lines)
+
+    def __len__(self):
+        return len(self._sources)